@@ -0,0 +1,83 @@
+"""缩略图解码基准：比较完整解码与按格式缩小解码的耗时
+
+用法: python bench_decode.py [--sizes 4000x3000,6000x4000] [--repeat 3]
+在临时目录生成 JPEG / PNG / WebP 测试图片，逐格式输出每张耗时、加速比、解码峰值内存和缩略图差异。
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import cv2
+import numpy as np
+from core_scanner import IMG_MAX_SIZE, decode_for_thumb
+
+# ===================== 配置 =====================
+FORMATS = {"jpeg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 92]), "png": (".png", []), "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 90])}
+
+def make_image(w, h, seed):
+    """生成类似照片的测试图：平滑的大尺度色块加细节噪声"""
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 255, (max(2, h // 256), max(2, w // 256), 3), dtype=np.uint8)
+    img = cv2.resize(base, (w, h), interpolation=cv2.INTER_CUBIC)
+    noise = rng.normal(0, 6, (h, w, 1)).astype(np.int16)
+    return np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+def thumb_size(w, h):
+    """缩略图尺寸（最长边为 IMG_MAX_SIZE，与扫描一致）"""
+    scale = IMG_MAX_SIZE / max(w, h)
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+def full_decode(data):
+    """原来的方式：完整解码"""
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    return img, img.shape[1], img.shape[0]
+
+def run(decode, data):
+    """解码并缩放到缩略图，返回 (缩略图, 解码数组字节数)"""
+    img, w, h = decode(data)
+    return cv2.resize(img, thumb_size(w, h), interpolation=cv2.INTER_AREA), img.nbytes
+
+def bench(decode, files, repeat):
+    """每张图片的平均耗时（毫秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for data in files:
+            run(decode, data)
+    return (time.perf_counter() - start) * 1000 / (repeat * len(files))
+
+def main():
+    parser = argparse.ArgumentParser(description="缩略图解码基准")
+    parser.add_argument("--sizes", default="4000x3000,6000x4000", help="测试图片尺寸，逗号分隔")
+    parser.add_argument("--count", type=int, default=2, help="每种尺寸生成的图片数")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in s.split("x")) for s in args.sizes.split(",")]
+    with tempfile.TemporaryDirectory() as folder:
+        corpus = {name: [] for name in FORMATS}
+        for k, (w, h) in enumerate(sizes):
+            for i in range(args.count):
+                img = make_image(w, h, k * 100 + i)
+                for name, (ext, params) in FORMATS.items():
+                    ok, enc = cv2.imencode(ext, img, params)
+                    path = os.path.join(folder, f"{w}x{h}_{i}{ext}")
+                    enc.tofile(path)
+                    with open(path, 'rb') as f:
+                        corpus[name].append(f.read())
+
+        print(f"图片尺寸: {args.sizes}，每种 {args.count} 张，重复 {args.repeat} 次")
+        print(f"{'格式':<6}{'完整解码':>10}{'按格式解码':>12}{'加速':>8}{'峰值内存':>16}{'缩略图差异':>12}")
+        for name, files in corpus.items():
+            full_ms = bench(full_decode, files, args.repeat)
+            fast_ms = bench(decode_for_thumb, files, args.repeat)
+            full_mem = max(run(full_decode, data)[1] for data in files)
+            fast_mem = max(run(decode_for_thumb, data)[1] for data in files)
+            diff = max(float(np.abs(run(full_decode, data)[0].astype(np.int16)
+                                    - run(decode_for_thumb, data)[0].astype(np.int16)).mean()) for data in files)
+            print(f"{name:<6}{full_ms:>9.1f}ms{fast_ms:>11.1f}ms{full_ms / fast_ms:>7.2f}x"
+                  f"{full_mem / 2 ** 20:>7.0f}→{fast_mem / 2 ** 20:>5.0f}MB{diff:>12.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""推理配置自动调优模块"""
+import os
+import copy
+import time
+import platform
+import multiprocessing
+from core_engine import BACKENDS, PruningBounds, iter_tiled_pairs, load_backend, thread_env, tile_block_size
+
+# ===================== 配置 =====================
+AUTOTUNE_SAMPLE = 128  # 参与测速的特征行数
+AUTOTUNE_SECONDS = 0.2  # 每种配置的测速时长
+AUTOTUNE_BLOCKS = (16, 32, 64)  # 候选分块边长（不超过内存预算）
+AUTOTUNE_POOL_TIMEOUT = 120  # 多进程测速时等待各进程就绪的最长秒数
+
+def machine_key(encoding, use_gpu):
+    """本机标识：机器名 + 架构 + CPU 核数，加上特征编码和是否允许 GPU"""
+    device = "gpu" if use_gpu else "cpu"
+    return f"{platform.node()}|{platform.machine()}|{os.cpu_count() or 1}|{encoding}|{device}"
+
+def thread_options(cpus):
+    """候选线程数：不超过核数的 2 的幂，再加上核数本身"""
+    options = []
+    t = 1
+    while t < cpus:
+        options.append(t)
+        t *= 2
+    options.append(cpus)
+    return options
+
+def measure_rate(head, n, block, threshold, bounds=None, seconds=AUTOTUNE_SECONDS):
+    """按比对时的分块路径（给出 bounds 时先精确剪枝）反复遍历全部组合，返回每秒组合数"""
+    head.tile_scores(0, min(block, n), 0, min(block, n))  # 预热
+    # 每次测速都从未试探过的剪枝状态开始，与真实比对一致
+    bounds = copy.copy(bounds)
+    pairs = 0
+    start = time.perf_counter()
+    while True:
+        for *_, count, _, _ in iter_tiled_pairs(head, n, threshold, block, bounds=bounds):
+            pairs += count
+            elapsed = time.perf_counter() - start
+            if elapsed >= seconds:
+                return pairs / elapsed
+
+# ===================== 多进程测速 =====================
+_worker_state = {}
+
+def init_autotune_worker(name, model_path, feats, threads, barrier, threshold, bounds):
+    """测速进程初始化：加载后端和模型，绑定特征样本"""
+    backend = load_backend(name)
+    backend.set_threads(threads)
+    head = backend.SimHead(backend.load_model(model_path, "cpu"), "cpu")
+    head.bind(feats)
+    _worker_state.update(head=head, n=len(feats), barrier=barrier, threshold=threshold, bounds=bounds)
+
+def autotune_worker(block):
+    """等所有进程都就绪后同时测速，返回本进程每秒组合数"""
+    _worker_state["barrier"].wait(AUTOTUNE_POOL_TIMEOUT)
+    return measure_rate(_worker_state["head"], _worker_state["n"], block,
+                        _worker_state["threshold"], _worker_state["bounds"])
+
+def measure_pool_rate(name, model_path, feats, threads, processes, block, threshold, bounds=None):
+    """在真实进程池中让 processes 个进程同时测速，返回合计每秒组合数（计入内存带宽等资源争用）"""
+    # 每个任务都要等齐 processes 个进程，保证各进程各取一个任务、同时计算
+    barrier = multiprocessing.Barrier(processes)
+    with thread_env(threads):
+        pool = multiprocessing.Pool(processes, initializer=init_autotune_worker,
+                                    initargs=(name, str(model_path), feats, threads, barrier, threshold, bounds))
+    with pool:
+        return sum(pool.map(autotune_worker, [block] * processes, chunksize=1))
+
+def autotune(model_path, feats, threshold, use_gpu=False, memory_mb=256, prune=False, log=print):
+    """在真实特征样本上测速 后端 × 设备 × 线程数 × 分块边长，返回最快的配置
+
+    CPU 上用 t 个线程时可同时运行 核数 // t 个进程：先在本进程测出各分块边长的速度，
+    再用其中最快的分块边长在真实进程池中实测多进程的合计速度。测速结束后恢复原来的线程数。
+    prune 为真时按比对阈值构建剪枝上界，测的是开启精确剪枝后的实际比对路径。
+    """
+    cpus = os.cpu_count() or 1
+    n = len(feats)
+    max_block = tile_block_size(feats.dim, memory_mb)
+    blocks = sorted({min(b, max_block) for b in AUTOTUNE_BLOCKS})
+    bounds = None
+    results = []
+
+    for name in BACKENDS:
+        try:
+            backend = load_backend(name)
+        except ImportError:
+            continue
+
+        devices = ["cpu"]
+        gpu = backend.pick_device(use_gpu)
+        if gpu != "cpu":
+            devices.insert(0, gpu)
+
+        original_threads = backend.get_threads()
+        try:
+            for device in devices:
+                try:
+                    head = backend.SimHead(backend.load_model(model_path, device), device)
+                    head.bind(feats)
+                except Exception as e:
+                    log(f"自动调优: 后端 {name} ({device}) 不可用: {str(e)}")
+                    continue
+                if prune and bounds is None:
+                    # 各后端加载的是同一份权重，剪枝统计量只需算一次
+                    bounds = PruningBounds(head.weights(), threshold)
+                    bounds.bind(feats)
+
+                for threads in ([cpus] if device != "cpu" else thread_options(cpus)):
+                    backend.set_threads(threads)
+                    rates = {block: measure_rate(head, n, block, threshold, bounds) for block in blocks}
+                    processes = 1 if device != "cpu" else max(1, cpus // threads)
+                    if processes == 1:
+                        results.extend({"backend": name, "device": device, "threads": threads, "processes": 1,
+                                        "block": block, "rate": rate} for block, rate in rates.items())
+                        continue
+                    block = max(rates, key=rates.get)
+                    try:
+                        rate = measure_pool_rate(name, model_path, feats, threads, processes, block,
+                                                 threshold, bounds)
+                    except Exception as e:
+                        log(f"自动调优: {name} {processes} 进程测速失败，跳过: {str(e)}")
+                        continue
+                    results.append({"backend": name, "device": device, "threads": threads,
+                                    "processes": processes, "block": block, "rate": rate})
+        finally:
+            # 调优只是试探，不能改变本进程之后的线程数
+            if original_threads:
+                backend.set_threads(original_threads)
+
+    if not results:
+        return None
+    best = max(results, key=lambda r: r["rate"])
+    for r in sorted(results, key=lambda r: -r["rate"])[:5]:
+        log(f"自动调优: {r['backend']} ({r['device']}) {r['processes']} 进程 × {r['threads']} 线程, "
+            f"分块 {r['block']}: {r['rate']:.0f} 对/秒")
+    return best
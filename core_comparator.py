@@ -1,13 +1,24 @@
 """比对模块"""
 import os
 import json
-import cv2,sys
+import sys
+
+import time
 import numpy as np
-import torch
-import torch.nn as nn
 import multiprocessing
-from functools import partial
 from pathlib import Path
+from core_features import (IMG_INPUT_SIZE, FeatureMatrix, FeatureStore, InputStore, attach_features,
+                           encode_features, file_hash, image_fingerprint, model_input)
+from core_index import (LSH_BITS, LSH_TABLES, LSH_WIDTH, LSHIndex, codes_to_pairs, estimate_recall,
+                        hamming_candidate_codes, pairs_to_codes)
+from core_scanner import flush_db, image_dhash, save_db
+from core_db import PairJournal
+from core_persist import atomic_write_json
+from core_groups import DisjointSet
+from core_thumbs import thumb_store
+from core_engine import (BACKENDS, PruningBounds, compare_range_worker, init_compare_worker, iter_tiled_pairs,
+                         load_backend, rows_done_pairs, thread_env, tile_block_size)
+from core_autotune import AUTOTUNE_SAMPLE, autotune, machine_key
 
 def get_resource_path(relative_path):
     if hasattr(sys, '_MEIPASS'):
@@ -17,10 +28,37 @@ def get_resource_path(relative_path):
 # ===================== 配置 =====================
 MODEL_PATH = get_resource_path("tiny_similarity.pth")
 TEMP_FOLDER = "_image_temp"
-DB_PATH = os.path.join(TEMP_FOLDER, "db.json")
+DB_PATH = os.path.join(TEMP_FOLDER, "db.sqlite")
 RESULT_JS = os.path.join(TEMP_FOLDER, "duplicates.js")
-IMG_INPUT_SIZE = 128
 PROCESS_NUM = max(1, multiprocessing.cpu_count())
+FEATURE_BATCH = 64
+COMPARE_CHUNKS_PER_PROCESS = 4  # 每个进程至少分到的任务段数
+
+def load_config_value(key, default):
+    """从配置文件读取单个配置项"""
+    config_path = os.path.join(TEMP_FOLDER, "config.json")
+    try:
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            return config.get(key, default)
+    except Exception as e:
+        print(f"读取配置项 {key} 失败，使用默认值: {str(e)}")
+    return default
+
+def save_config_value(key, value):
+    """写入单个配置项，保留配置文件中的其他项"""
+    config_path = os.path.join(TEMP_FOLDER, "config.json")
+    try:
+        config = {}
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        config[key] = value
+        os.makedirs(TEMP_FOLDER, exist_ok=True)
+        atomic_write_json(config_path, config, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"保存配置项 {key} 失败: {str(e)}")
 
 def load_similarity_threshold():
     """从配置文件加载相似度阈值"""
@@ -42,121 +80,112 @@ def load_similarity_threshold():
         return default_threshold
 
 SIMILARITY_THRESH = load_similarity_threshold()
+TILE_MEMORY_MB = int(load_config_value("tile_memory_mb", 256))  # 单个比对块的内存预算
+PRUNE_PAIRS = bool(load_config_value("prune_pairs", True))  # 精确剪枝：跳过可证明达不到阈值的组合
+COMPARE_STRATEGY = load_config_value("compare_strategy", "full")  # full = 全量两两比对，ann = 近邻候选，phash = 感知哈希预筛选
+ANN_PARAMS = {
+    "tables": int(load_config_value("ann_tables", LSH_TABLES)),
+    "bits": int(load_config_value("ann_bits", LSH_BITS)),
+    "width": float(load_config_value("ann_width", LSH_WIDTH)),
+}
+ANN_RECALL_SAMPLE = int(load_config_value("ann_recall_sample", 20))  # 召回率抽样行数，0 为不检查
+PHASH_RADIUS = int(load_config_value("phash_radius", 10))  # 感知哈希预筛选的汉明半径，越大召回越高
+FEATURE_ENCODING = load_config_value("feature_encoding", "float32")  # 特征库编码：float32 / float16 / int8
+FEATURE_DRIFT_SAMPLE = int(load_config_value("feature_drift_sample", 64))  # 量化误差抽样图片数，0 为不检查
+FEATURE_DRIFT_BAND = 0.005  # 统计阈值附近 ±此范围内的组合
+INFERENCE_BACKEND = load_config_value("inference_backend", "auto")  # auto = 自动调优，或 torch / torch_jit / numpy（numpy 不依赖 torch，只支持 CPU）
 
 # ===================== 模型 =====================
-class TinyModel(nn.Module):
-    def __init__(self):
-        super().__init__()
-        self.feat = nn.Sequential(
-            nn.Conv2d(3, 8, 3, 2, 1), nn.ReLU(),
-            nn.Conv2d(8, 16, 3, 2, 1), nn.ReLU(),
-            nn.Flatten()
-        )
-        self.sim = nn.Sequential(
-            nn.Linear(16 * 32 * 32, 32), nn.ReLU(),
-            nn.Linear(32, 1), nn.Sigmoid()
-        )
+_model_hash = None
 
-    def forward(self, x1, x2):
-        f1 = self.feat(x1)
-        f2 = self.feat(x2)
-        return self.sim(torch.abs(f1 - f2)).squeeze()
+def get_model_hash():
+    """模型文件哈希，切换A/B模型时特征缓存自动失效"""
+    global _model_hash
+    if _model_hash is None:
+        _model_hash = file_hash(MODEL_PATH)
+    return _model_hash
 
-def load_model_for_device(device="cpu"):
-    """加载模型到指定设备"""
-    model = TinyModel()
-    model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
-    if device != "cpu":
-        model = model.to(device)
-    model.eval()
-    return model
-
-# ===================== 中文路径 =====================
-def cv2_imread(file_path):
-    try:
-        stream = open(file_path, 'rb')
-        bytes = bytearray(stream.read())
-        numpyarray = np.asarray(bytes, dtype=np.uint8)
-        return cv2.imdecode(numpyarray, cv2.IMREAD_UNCHANGED)
-    except:
-        return None
-
-def process_image_tensor(path, device="cpu"):
-    """处理图片为张量"""
-    img = cv2_imread(path)
+# ===================== 图片读取 =====================
+def load_image_array(thumb):
+    """从缩略图库读取缩略图并预处理为模型输入数组 (3, H, W)"""
+    img = thumb_store().read_image(thumb)
     if img is None:
         return None
-    if len(img.shape) == 2:
-        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-    else:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = cv2.resize(img, (IMG_INPUT_SIZE, IMG_INPUT_SIZE))
-    img = img.astype(np.float32) / 255.0
-    img = img.transpose(2, 0, 1)
-    t = torch.tensor(img).unsqueeze(0)
-    if device != "cpu":
-        t = t.to(device)
-    return t
-
-def similarity_mp(args, threshold):
-    """多进程相似度计算函数"""
-    thumbA, thumbB, pathA, pathB = args
-    try:
-        model = TinyModel()
-        model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
-        model.eval()
-        
-        imgA = cv2_imread(thumbA)
-        imgB = cv2_imread(thumbB)
-        
-        if imgA is None or imgB is None:
-            return None
-            
-        def preprocess(img):
-            if len(img.shape) == 2:
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-            else:
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            img = cv2.resize(img, (IMG_INPUT_SIZE, IMG_INPUT_SIZE))
-            img = img.astype(np.float32) / 255.0
-            img = img.transpose(2, 0, 1)
-            return torch.tensor(img).unsqueeze(0)
-        
-        t1 = preprocess(imgA)
-        t2 = preprocess(imgB)
-        
-        with torch.no_grad():
-            sim = float(model(t1, t2).item())
-        
-        if sim >= threshold:
-            return tuple(sorted((pathA, pathB)))
-        else:
-            return None
-    except Exception as e:
-        return None
+    img = model_input(img).astype(np.float32) / 255.0
+    return img.transpose(2, 0, 1)
 
 class Comparator:
     """比对器类"""
     
-    def __init__(self, db, progress_callback=None, log_callback=None,use_gpu=False, threshold=SIMILARITY_THRESH):
+    def __init__(self, db, progress_callback=None, log_callback=None,use_gpu=False, threshold=SIMILARITY_THRESH,
+                 tile_memory_mb=TILE_MEMORY_MB, prune=PRUNE_PAIRS, strategy=COMPARE_STRATEGY,
+                 ann_params=None, phash_radius=PHASH_RADIUS, feature_encoding=FEATURE_ENCODING,
+                 backend=INFERENCE_BACKEND):
         self.db = db
         self.progress_callback = progress_callback
         self.log_callback = log_callback
         self.use_gpu = use_gpu
         self.threshold = threshold
+        self.tile_memory_mb = tile_memory_mb
+        self.prune = prune
+        self.strategy = strategy
+        self.ann_params = dict(ANN_PARAMS, **(ann_params or {}))
+        self.phash_radius = phash_radius
+        self.feature_encoding = feature_encoding
+        self.pair_stats = {"pairs": 0, "evaluated": 0}
+        self.found_pairs = {}
+        self.groups = DisjointSet()
+        self.journal = PairJournal()
         self.comparing = False
         self.stop_requested = False
+        self.block_size = None
+        self.processes = PROCESS_NUM
+        self.threads = max(1, multiprocessing.cpu_count() // PROCESS_NUM)
+        self.auto_backend = backend == "auto"
+        self.set_backend("torch" if self.auto_backend else backend)
+    
+    def set_backend(self, name, device=None):
+        """切换推理后端和计算设备，后端不可用时改用 numpy"""
+        try:
+            self.backend = load_backend(name)
+            self.backend_name = name
+        except ImportError as e:
+            print(f"推理后端 {name} 不可用，改用 numpy: {str(e)}")
+            self.backend = load_backend("numpy")
+            self.backend_name = "numpy"
+            device = None
         
-        if use_gpu:
-            if torch.cuda.is_available():
-                self.device = "cuda"
-            elif torch.backends.mps.is_available():
-                self.device = "mps"
-            else:
-                self.device = "cpu"
-                self.use_gpu = False
-        else:
-            self.device = "cpu"
+        self.device = device or self.backend.pick_device(self.use_gpu)
+        self.use_gpu = self.device != "cpu"
+    
+    def apply_autotune(self, file_list):
+        """按本机缓存的调优结果选择推理配置，没有缓存时在前几张图片的真实特征上测速"""
+        key = machine_key(self.feature_encoding, self.use_gpu)
+        cache = load_config_value("autotune", {})
+        best = cache.get(key)
+        if not best or best.get("backend") not in BACKENDS:
+            store, rows, _ = self.extract_features(file_list[:AUTOTUNE_SAMPLE])
+            if len(rows) < 2 or self.stop_requested:
+                return
+            self.log("本机首次比对，自动调优推理配置...")
+            best = autotune(MODEL_PATH, store.matrix(rows), self.threshold, self.use_gpu, self.tile_memory_mb,
+                            self.prune, self.log)
+            if best is None:
+                return
+            cache[key] = best
+            save_config_value("autotune", cache)
+        
+        self.set_backend(best["backend"], best["device"])
+        self.block_size = best["block"]
+        self.processes = best["processes"]
+        self.threads = best["threads"]
+        self.log(f"推理配置: {self.backend_name} ({self.device})，{self.processes} 进程 × {self.threads} 线程，"
+                 f"分块 {self.block_size}")
+    
+    def tile_block(self, dim):
+        """分块边长：调优结果优先，但不超过内存预算"""
+        block = tile_block_size(dim, self.tile_memory_mb)
+        return min(block, self.block_size) if self.block_size else block
     
     def log(self, message):
         """记录日志"""
@@ -168,121 +197,400 @@ class Comparator:
         if self.progress_callback:
             self.progress_callback(current, total, message)
     
-    def compare_gpu(self, file_list, start_idx=0):
-        """GPU比对"""
-        self.log(f"使用GPU进行比对 (设备: {self.device})")
-        
-        model = load_model_for_device(self.device)
+    def load_model(self, device=None):
+        """用当前后端加载模型"""
+        return self.backend.load_model(MODEL_PATH, device or self.device)
+    
+    def make_head(self, model=None, device=None):
+        """用当前后端构建批量 sim 头"""
+        device = device or self.device
+        return self.backend.SimHead(model or self.load_model(device), device)
+    
+    def feature_batch(self, model, paths, fingerprints=None, inputs=None):
+        """对一批图片运行 TinyModel.feat，返回 (float32 特征, 成功的序号)
+
+        扫描时已缓存模型输入的图片直接从内存映射读取，其余解码缩略图。
+        """
+        cached = np.full(len(paths), -1, dtype=np.int64)
+        if inputs is not None and fingerprints is not None:
+            cached = inputs.lookup(fingerprints)
+        hits = np.flatnonzero(cached >= 0)
+        batch = np.zeros((len(paths), 3, IMG_INPUT_SIZE, IMG_INPUT_SIZE), dtype=np.float32)
+        if len(hits):
+            batch[hits] = inputs.read(cached[hits]).transpose(0, 3, 1, 2).astype(np.float32) / 255.0
+        ok = []
+        for k, p in enumerate(paths):
+            if cached[k] >= 0:
+                ok.append(k)
+                continue
+            arr = load_image_array(self.db["files"][p]["thumb"])
+            if arr is not None:
+                batch[k] = arr
+                ok.append(k)
+        if not ok:
+            return None, ok
+        return self.backend.extract_batch(model, batch[ok], self.device), ok
+    
+    def extract_features(self, file_list):
+        """特征提取：每张图片只运行一次 TinyModel.feat，结果写入特征库"""
+        store = FeatureStore(get_model_hash(), encoding=self.feature_encoding)
         n = len(file_list)
-        total_pairs = n * (n - 1) // 2
-        
-        duplicates = set()
-        done = start_idx
-        
-        tensors = []
-        valid_indices = []
-        
-        self.log("预加载图片张量...")
-        for i, path in enumerate(file_list):
-            thumb_path = self.db["files"][path]["thumb"]
-            tensor = process_image_tensor(thumb_path, self.device)
-            if tensor is not None:
-                tensors.append(tensor)
-                valid_indices.append(i)
-            self.update_progress(i + 1, n, f"加载张量: {i+1}/{n}")
-        
-        self.log(f"成功加载 {len(tensors)}/{n} 个有效张量")
-        
-        # 计算已经处理了多少对
-        processed_pairs = 0
-        for idx_i, i in enumerate(valid_indices):
-            for idx_j, j in enumerate(valid_indices[idx_i + 1:]):
-                if processed_pairs < start_idx:
-                    processed_pairs += 1
-                    continue
-                    
+        fingerprints = [image_fingerprint(p, self.db["files"][p]) for p in file_list]
+        rows = store.lookup(fingerprints)
+        missing = [i for i in range(n) if rows[i] < 0 and fingerprints[i]]
+        self.log(f"特征缓存命中 {n - len(missing)}/{n}，需提取 {len(missing)} 张")
+        
+        if missing:
+            model = self.load_model()
+            inputs = InputStore()
+            for start in range(0, len(missing), FEATURE_BATCH):
                 if self.stop_requested:
                     break
-                    
-                t1 = tensors[idx_i]
-                t2 = tensors[idx_i + 1 + idx_j]
-                done += 1
-                
-                try:
-                    with torch.no_grad():
-                        sim = float(model(t1, t2).item())
-                    
-                    if sim >= self.threshold:
-                        duplicates.add(tuple(sorted((file_list[i], file_list[j]))))
                 
-                except Exception as e:
-                    self.log(f"比对 {file_list[i]} <-> {file_list[j]} 时出错: {str(e)}")
+                batch = missing[start:start + FEATURE_BATCH]
+                feats, ok = self.feature_batch(model, [file_list[i] for i in batch],
+                                               [fingerprints[i] for i in batch], inputs)
+                ok = [batch[k] for k in ok]
                 
-                # 更新进度
-                if done % 100 == 0 or done == total_pairs:
-                    self.update_progress(done, total_pairs, f"比对: {done}/{total_pairs}")
+                if ok:
+                    ok_fps = [fingerprints[i] for i in ok]
+                    store.append(ok_fps, feats)
+                    rows[ok] = store.lookup(ok_fps)
                 
-                # 每1000组保存一次进度
-                if done % 1000 == 0:
-                    self.db["compare_index"] = done
-                    with open(DB_PATH, 'w', encoding='utf-8') as f:
-                        json.dump(self.db, f, ensure_ascii=False, indent=2)
+                done = min(start + FEATURE_BATCH, len(missing))
+                self.update_progress(done, len(missing), f"提取特征: {done}/{len(missing)}")
+            store.save()
         
+        valid_indices = [i for i in range(n) if rows[i] >= 0]
+        self.log(f"成功加载 {len(valid_indices)}/{n} 个有效特征")
+        return store, rows[valid_indices], valid_indices
+    
+    def new_rows(self, indices, new_count):
+        """前 new_count 张图片在有效序号列表中占的行数（None 表示全部）"""
+        if new_count is None:
+            return len(indices)
+        return int(np.searchsorted(indices, new_count))
+    
+    def pair_key(self, a, b):
+        """两个路径的重复对键：记录表中的 (较小行号, 较大行号)，任一路径不在表中时返回 None"""
+        files = self.db["files"]
+        i, j = files.row_of(a), files.row_of(b)
+        if i is None or j is None:
+            return None
+        return (i, j) if i < j else (j, i)
+    
+    def pairs_from_paths(self, pairs):
+        """[(a, b, score)] 路径形式的重复对转为 {行号对: 分数}"""
+        out = {}
+        for a, b, score in pairs:
+            key = self.pair_key(a, b)
+            if key is not None:
+                out[key] = score
+        return out
+    
+    def pairs_to_paths(self, duplicates):
+        """{行号对: 分数} 转回 [[a, b, score]]，a < b"""
+        path_of = self.db["files"].path_of
+        return [sorted((path_of(i), path_of(j))) + [score] for (i, j), score in duplicates.items()]
+    
+    def record_pair(self, a, b, score):
+        """记录一个重复对（按行号保存），同时以路径形式追加到比对日志"""
+        key = self.pair_key(a, b)
+        if key is None:
+            return
+        score = float(score)
+        self.found_pairs[key] = score
+        self.groups.union(*key)
+        self.journal.append(*sorted((a, b)), score)
+    
+    def reset_found(self, pairs=None):
+        """重设本轮已找到的重复对 {行号对: 分数}，并查集随之重建"""
+        self.found_pairs = dict(pairs or {})
+        self.groups = DisjointSet()
+        for i, j in self.found_pairs:
+            self.groups.union(i, j)
+    
+    def current_groups(self):
+        """当前的相似分组（路径，组内排序，大组在前），比对进行中也可随时调用"""
+        path_of = self.db["files"].path_of
+        groups = [sorted(path_of(r) for r in group) for group in self.groups.groups()]
+        groups.sort(key=len, reverse=True)
+        return groups
+    
+    def save_compare_index(self, done):
+        """保存比对进度（本轮找到的重复对先在比对日志中落盘）"""
+        self.journal.sync()
+        self.db["compare_index"] = done
+        save_db(self.db, ("compare_index",))
+    
+    def make_bounds(self, head, feats, path=None):
+        """构建精确剪枝上界（未开启剪枝时返回 None），path 为 feats 对应的共享矩阵文件"""
+        if not self.prune:
+            return None
+        bounds = PruningBounds(head.weights(), self.threshold)
+        bounds.bind(feats, path=path)
+        return bounds
+    
+    def report_feature_drift(self, file_list, duplicates):
+        """抽样比较压缩编码与 float32 特征的相似度，报告量化误差
+
+        抽样优先取本轮重复对涉及的图片（分数集中在阈值附近），其余随机补足。
+        """
+        rng = np.random.default_rng(0)
+        files = self.db["files"]
+        sample = list(dict.fromkeys(files.path_of(r) for pair in duplicates for r in pair))
+        sample = [p for p in sample if p in files]
+        sample = sample[:FEATURE_DRIFT_SAMPLE // 2]
+        chosen = set(sample)
+        rest = [p for p in file_list if p not in chosen]
+        extra = FEATURE_DRIFT_SAMPLE - len(sample)
+        if rest and extra > 0:
+            sample += [rest[k] for k in rng.choice(len(rest), size=min(extra, len(rest)), replace=False)]
+        
+        model = self.load_model()
+        feats, ok = self.feature_batch(model, sample)
+        if feats is None or len(ok) < 2:
+            return
+        
+        head = self.make_head(model)
+        k = len(ok)
+        upper = np.triu_indices(k, 1)
+        head.bind(feats)
+        exact = head.tile_scores(0, k, 0, k)[upper]
+        head.bind(FeatureMatrix(*encode_features(feats, self.feature_encoding)))
+        approx = head.tile_scores(0, k, 0, k)[upper]
+        
+        drift = np.abs(approx - exact)
+        band = np.abs(exact - self.threshold) <= FEATURE_DRIFT_BAND
+        flips = int(((exact >= self.threshold) != (approx >= self.threshold)).sum())
+        band_max = f"{drift[band].max():.2e}" if band.any() else "-"
+        self.log(f"量化误差 ({self.feature_encoding}): 抽样 {len(drift)} 对，最大 {drift.max():.2e}，"
+                 f"平均 {drift.mean():.2e}；阈值±{FEATURE_DRIFT_BAND} 内 {int(band.sum())} 对，"
+                 f"最大 {band_max}，判定改变 {flips} 对")
+    
+    def log_pair_stats(self):
+        """输出剪枝统计"""
+        pairs = self.pair_stats["pairs"]
+        evaluated = self.pair_stats["evaluated"]
+        if self.prune and pairs:
+            self.log(f"剪枝统计: 共 {pairs} 对，跳过 {pairs - evaluated} 对，"
+                     f"实际计算 {evaluated} 对 ({evaluated / pairs:.1%})")
+    
+    def compare_tiled(self, head, file_list, start_idx=0, new_count=None):
+        """分块批量比对：整块计算 sim 头，只返回超过阈值的组合"""
+        store, rows, valid_indices = self.extract_features(file_list)
+        m = len(valid_indices)
+        total_pairs = rows_done_pairs(self.new_rows(valid_indices, new_count), m)
+        duplicates = self.found_pairs
+        if m < 2 or self.stop_requested:
+            return duplicates
+        
+        feats = store.matrix(rows)
+        head.bind(feats)
+        bounds = self.make_bounds(head, feats)
+        block = self.tile_block(store.dim)
+        self.log(f"分块比对: 每块 {block}x{block} 组合 (内存预算 {self.tile_memory_mb}MB)")
+        
+        # 断点续比：线性序号直接反解到 (i, j)
+        done = min(start_idx, total_pairs)
+        last_update = 0
+        
+        for i0, i1, j0, j1, count, evaluated, found in iter_tiled_pairs(
+                head, m, self.threshold, block, done, total_pairs, bounds=bounds):
+            if self.stop_requested:
+                break
+            
+            self.pair_stats["pairs"] += count
+            self.pair_stats["evaluated"] += evaluated
+            for i, j, score in found:
+                self.record_pair(file_list[valid_indices[i]], file_list[valid_indices[j]], score)
+            done += count
+            
+            # 更新进度
+            now = time.time()
+            if now - last_update >= 0.2 or done == total_pairs:
+                last_update = now
+                self.update_progress(done, total_pairs, f"比对: {done}/{total_pairs}")
+            
+            # 每完成一个行带保存一次进度
+            if j1 == m:
+                self.save_compare_index(min(rows_done_pairs(i1, m), total_pairs))
+        
+        self.log_pair_stats()
+        return duplicates
+    
+    def compare_gpu(self, file_list, start_idx=0, new_count=None):
+        """GPU比对"""
+        self.log(f"使用GPU进行比对 (设备: {self.device})")
+        head = self.make_head()
+        return self.compare_tiled(head, file_list, start_idx, new_count)
+    
+    def compare_candidates(self, head, codes, m, file_list, valid_indices, block, start_idx=0):
+        """按候选组合编码分批计算 sim 头，进度按候选序号保存"""
+        duplicates = self.found_pairs
+        total = len(codes)
+        done = min(start_idx, total)
+        batch = block * block
+        for start in range(done, total, batch):
+            if self.stop_requested:
+                break
+            
+            ii, jj = codes_to_pairs(codes[start:start + batch], m)
+            scores = head.pair_scores(ii, jj)
+            for k in np.flatnonzero(scores >= self.threshold):
+                self.record_pair(file_list[valid_indices[ii[k]]], file_list[valid_indices[jj[k]]], scores[k])
+            done = min(start + batch, total)
+            
+            self.update_progress(done, total, f"比对候选: {done}/{total}")
+            self.save_compare_index(done)
         return duplicates
     
-    def compare_cpu(self, file_list, start_idx=0):
-        """CPU多进程比对"""
-        self.log(f"使用多进程进行比对 (进程数: {PROCESS_NUM})")
+    def compare_ann(self, file_list, start_idx=0, new_count=None):
+        """近邻候选比对：LSH 索引选出候选组合，只对候选计算 sim 头"""
+        self.log(f"使用近邻索引进行比对 (设备: {self.device}, 参数: {self.ann_params})")
         
-        n = len(file_list)
-        total_pairs = n * (n - 1) // 2
+        store, rows, valid_indices = self.extract_features(file_list)
+        m = len(valid_indices)
+        duplicates = self.found_pairs
+        if m < 2 or self.stop_requested:
+            return duplicates
+        
+        feats = store.matrix(rows)
+        head = self.make_head()
+        head.bind(feats)
+        block = self.tile_block(store.dim)
         
-        tasks = []
-        for i in range(n):
-            for j in range(i + 1, n):
-                a = file_list[i]
-                b = file_list[j]
-                ta = self.db["files"][a]["thumb"]
-                tb = self.db["files"][b]["thumb"]
-                tasks.append((ta, tb, a, b))
+        codes = LSHIndex(store.dim, **self.ann_params).fit(feats).candidate_codes()
+        # 候选编码按 i 有序，只取涉及新图片（排在最前）的部分
+        codes = codes[:np.searchsorted(codes, self.new_rows(valid_indices, new_count) * m)]
+        total = len(codes)
+        full_pairs = m * (m - 1) // 2
+        self.log(f"候选组合 {total}/{full_pairs} ({total / full_pairs:.2%})")
         
-        pool = multiprocessing.Pool(PROCESS_NUM)
-        func = partial(similarity_mp, threshold=self.threshold)
+        duplicates = self.compare_candidates(head, codes, m, file_list, valid_indices, block, start_idx)
+        
+        if ANN_RECALL_SAMPLE > 0 and not self.stop_requested:
+            hit, expected = estimate_recall(head, m, self.threshold, codes, block, ANN_RECALL_SAMPLE)
+            if expected:
+                self.log(f"召回率抽样: {hit}/{expected} ({hit / expected:.1%})")
+            else:
+                self.log("召回率抽样: 抽样行中没有重复对")
         
-        duplicates = set()
-        done = start_idx
+        return duplicates
+    
+    def load_dhashes(self, file_list):
+        """读取每张图片的感知哈希，旧数据库中缺失的从缩略图补算"""
+        files = self.db["files"]
+        hashes = []
+        computed = 0
+        for p in file_list:
+            info = files[p]
+            if not info.get("dhash"):
+                img = thumb_store().read_image(info["thumb"])
+                if img is not None:
+                    info["dhash"] = image_dhash(img)
+                    files.touch(p)
+                    computed += 1
+            hashes.append(info.get("dhash"))
+        if computed:
+            # 补算结果写回数据库，下次不再重复解码
+            save_db(self.db, ())
+            self.log(f"补算感知哈希 {computed} 张")
+        return hashes
+    
+    def compare_phash(self, file_list, start_idx=0, new_count=None):
+        """感知哈希预筛选比对：多索引汉明搜索选出候选组合，只对候选图片提取特征并计算 sim 头"""
+        self.log(f"使用感知哈希预筛选进行比对 (设备: {self.device}, 汉明半径: {self.phash_radius})")
+        
+        hashes = self.load_dhashes(file_list)
+        known = [i for i, h in enumerate(hashes) if h]
+        values = np.array([int(hashes[i], 16) for i in known], dtype=np.uint64)
+        codes = hamming_candidate_codes(values, self.phash_radius)
+        n = len(known)
+        codes = codes[:np.searchsorted(codes, self.new_rows(known, new_count) * n)]
+        full_pairs = n * (n - 1) // 2
+        self.log(f"候选组合 {len(codes)}/{full_pairs} ({len(codes) / max(1, full_pairs):.2%})")
+        if len(codes) == 0 or self.stop_requested:
+            return self.found_pairs
+        
+        # 只有出现在候选组合中的图片需要提取特征
+        ii, jj = codes_to_pairs(codes, n)
+        involved = np.unique(np.concatenate([ii, jj]))
+        sub_list = [file_list[known[k]] for k in involved]
+        store, rows, valid_indices = self.extract_features(sub_list)
+        m = len(valid_indices)
+        if m < 2 or self.stop_requested:
+            return self.found_pairs
+        
+        # 候选编码换成有效特征的行号（单调映射，编码仍保持有序）
+        pos = np.full(n, -1, dtype=np.int64)
+        pos[involved[valid_indices]] = np.arange(m)
+        keep = (pos[ii] >= 0) & (pos[jj] >= 0)
+        codes = pairs_to_codes(pos[ii[keep]], pos[jj[keep]], m)
+        
+        feats = store.matrix(rows)
+        head = self.make_head()
+        head.bind(feats)
+        block = self.tile_block(store.dim)
+        return self.compare_candidates(head, codes, m, sub_list, valid_indices, block, start_idx)
+    
+    def compare_cpu(self, file_list, start_idx=0, new_count=None):
+        """CPU多进程比对：进程池按连续序号段并行，结果按顺序流回"""
+        if self.processes == 1:
+            self.log(f"使用单进程进行比对 (线程数: {self.threads}, 推理后端: {self.backend_name})")
+            self.backend.set_threads(self.threads)
+            return self.compare_tiled(self.make_head(), file_list, start_idx, new_count)
+        
+        self.log(f"使用多进程进行比对 (进程数: {self.processes}, 推理后端: {self.backend_name})")
+        
+        store, rows, valid_indices = self.extract_features(file_list)
+        m = len(valid_indices)
+        total_pairs = rows_done_pairs(self.new_rows(valid_indices, new_count), m)
+        duplicates = self.found_pairs
+        if m < 2 or total_pairs == 0 or self.stop_requested:
+            return duplicates
+        
+        block = self.tile_block(store.dim)
+        # 任务段尽量覆盖完整的行带，同时保证每个进程都能分到任务
+        chunk = max(1, min(block * m, -(-total_pairs // (self.processes * COMPARE_CHUNKS_PER_PROCESS))))
+        threads = self.threads
+        done = min(start_idx, total_pairs)
+        tasks = ((s, min(s + chunk, total_pairs)) for s in range(done, total_pairs, chunk))
+        self.log(f"分块比对: 每块 {block}x{block} 组合，每段 {chunk} 组合，每进程 {threads} 线程")
+        
+        # 特征矩阵只发布一次，各进程通过内存映射共享
+        matrix_path = store.publish(rows)
+        # 剪枝统计量同样落盘共享，子进程按文件名挂载，不经 initargs 序列化
+        bounds = self.make_bounds(self.make_head(device="cpu"), attach_features(matrix_path), matrix_path)
+
+        # 子进程启动时按环境变量初始化 BLAS 线程池，进程池建好后恢复本进程的环境变量
+        with thread_env(threads):
+            pool = multiprocessing.Pool(
+                self.processes, initializer=init_compare_worker,
+                initargs=(self.backend_name, str(MODEL_PATH), matrix_path, self.threshold, block, threads, bounds))
         
         try:
-            # 跳过已经处理的任务
-            for idx, task in enumerate(tasks):
-                if idx < start_idx:
-                    continue
-                    
+            for start, stop, evaluated, found in pool.imap(compare_range_worker, tasks):
                 if self.stop_requested:
                     break
-                    
-                res = func(task)
-                done += 1
                 
-                if res:
-                    duplicates.add(res)
+                self.pair_stats["pairs"] += stop - start
+                self.pair_stats["evaluated"] += evaluated
+                for i, j, score in found:
+                    self.record_pair(file_list[valid_indices[i]], file_list[valid_indices[j]], score)
+                done = stop
                 
-                # 更新进度
-                if done % 100 == 0 or done == total_pairs:
-                    self.update_progress(done, total_pairs, f"比对: {done}/{total_pairs}")
-                
-                # 每1000组保存一次进度
-                if done % 1000 == 0:
-                    self.db["compare_index"] = done
-                    with open(DB_PATH, 'w', encoding='utf-8') as f:
-                        json.dump(self.db, f, ensure_ascii=False, indent=2)
+                self.update_progress(done, total_pairs, f"比对: {done}/{total_pairs}")
+                self.save_compare_index(done)
         
         except Exception as e:
             self.log(f"多进程比对出错: {str(e)}")
+            raise
         finally:
-            pool.close()
+            pool.terminate()
             pool.join()
         
+        self.log_pair_stats()
         return duplicates
     
     def start_compare(self):
@@ -294,7 +602,9 @@ class Comparator:
         self.stop_requested = False
         
         try:
-            file_list = list(self.db["files"].keys())
+            # 字节完全相同的副本不参与比对，结果中直接与代表文件成对
+            files = self.db["files"]
+            file_list = [p for p, info in files.items() if not info.get("copy_of")]
             if not file_list:
                 self.log("没有可比的图片")
                 return False
@@ -304,38 +614,62 @@ class Comparator:
             
             self.log(f"开始比对 {n} 张图片，共 {total_pairs} 对组合")
             
-            # 检查断点续扫
-            last_compare_count = self.db.get("last_compare_count", 0)
-            compare_index = self.db.get("compare_index", 0)
+            order, new_count = self.plan_compare(file_list)
+            start_idx = self.db.get("compare_index", 0)
+            if new_count == 0:
+                self.log("没有新增或改动的图片，只更新比对结果")
+            elif new_count < n:
+                self.log(f"增量比对: {new_count} 张新增或改动的图片，"
+                         f"共 {rows_done_pairs(new_count, n)} 对组合")
+            if start_idx > 0:
+                self.log(f"续比对：从第 {start_idx} 组开始")
             
-            if len(file_list) != last_compare_count:
-                self.log("检测到文件数量变化，重置比对进度...")
-                self.db["compare_index"] = 0
-                self.db["last_compare_count"] = len(file_list)
-                with open(DB_PATH, 'w', encoding='utf-8') as f:
-                    json.dump(self.db, f, ensure_ascii=False, indent=2)
-                start_idx = 0
-            else:
-                start_idx = compare_index
-                if start_idx >= total_pairs:
-                    self.log("比对进度：已完成")
-                    return True
-                self.log(f"续比对：从第 {start_idx}/{total_pairs} 组开始")
+            if self.auto_backend and new_count:
+                self.apply_autotune(order)
             
             # 执行比对
-            if self.use_gpu:
-                duplicates = self.compare_gpu(file_list, start_idx)
+            if new_count == 0:
+                duplicates = self.found_pairs
+            elif self.strategy == "ann":
+                duplicates = self.compare_ann(order, start_idx, new_count)
+            elif self.strategy == "phash":
+                duplicates = self.compare_phash(order, start_idx, new_count)
+            elif self.use_gpu:
+                duplicates = self.compare_gpu(order, start_idx, new_count)
             else:
-                duplicates = self.compare_cpu(file_list, start_idx)
+                duplicates = self.compare_cpu(order, start_idx, new_count)
+            
+            if self.stop_requested:
+                self.log("比对已停止，进度已保存")
+                return False
+            
+            if self.feature_encoding != "float32" and FEATURE_DRIFT_SAMPLE > 0:
+                self.report_feature_drift(order, duplicates)
+            
+            duplicates = self._merge_previous(duplicates, order[new_count:])
+            duplicates = self._expand_exact_copies(duplicates)
             
             # 将重复对转换为相似图片分组
             duplicate_groups = self._convert_to_groups(duplicates)
             
-            self.db["duplicates"] = [list(x) for x in duplicates]
+            self.db["duplicates"] = self.pairs_to_paths(duplicates)
             self.db["duplicate_groups"] = duplicate_groups  
-            self.db["compare_index"] = total_pairs 
-            with open(DB_PATH, 'w', encoding='utf-8') as f:
-                json.dump(self.db, f, ensure_ascii=False, indent=2)
+            self.db["compared_files"] = dict(zip(self.db["compare_plan"]["order"],
+                                                 self.db["compare_plan"]["fingerprints"]))
+            self.db["compare_settings"] = self.db["compare_plan"]["settings"]
+            
+            # 删除或改动的图片留下的特征行成为废弃数据，比例过高时压缩
+            store = FeatureStore(get_model_hash(), encoding=self.feature_encoding)
+            store.retain(self.db["compare_plan"]["fingerprints"])
+            store.save()
+            if store.compact():
+                self.log("特征库已压缩")
+            for key in ("compare_plan", "compare_found", "compare_index"):
+                self.db.pop(key, None)
+            save_db(self.db)
+            # 结果落盘后比对日志才能删除
+            if flush_db():
+                self.journal.clear()
             
             with open(RESULT_JS, 'w', encoding='utf-8') as f:
                 f.write(f"const duplicates={json.dumps(self.db['duplicates'], ensure_ascii=False)};")
@@ -350,44 +684,86 @@ class Comparator:
             self.log(f"比对过程中出错: {str(e)}")
             return False
         finally:
+            self.journal.close()
             self.comparing = False
     
-    def _convert_to_groups(self, duplicates):
-        """将重复对转换为相似图片分组"""
-        graph = {}
-        for a, b in duplicates:
-            if a not in graph:
-                graph[a] = set()
-            if b not in graph:
-                graph[b] = set()
-            graph[a].add(b)
-            graph[b].add(a)
-        
-        # 使用深度优先搜索找到连通分量
-        visited = set()
-        groups = []
-        
-        for node in graph:
-            if node not in visited:
-                stack = [node]
-                group = []
-                
-                while stack:
-                    current = stack.pop()
-                    if current not in visited:
-                        visited.add(current)
-                        group.append(current)
-                        for neighbor in graph[current]:
-                            if neighbor not in visited:
-                                stack.append(neighbor)
-                
-                group.sort()
-                if len(group) > 1:
-                    groups.append(group)
+    def compare_settings(self):
+        """影响比对结果的设置，任一改变时之前的结果不能沿用"""
+        settings = {"strategy": self.strategy, "threshold": self.threshold, "model": get_model_hash(),
+                    "encoding": self.feature_encoding}
+        if self.strategy == "ann":
+            settings["ann"] = self.ann_params
+        elif self.strategy == "phash":
+            settings["phash_radius"] = self.phash_radius
+        return settings
+    
+    def plan_compare(self, file_list):
+        """确定本轮比对顺序：新增或改动的图片排在最前，只需比对前 new_count 行的组合
+
+        上次完成后未改动的图片之间的结果直接沿用。未完成的比对计划在图片不变时继续。
+        返回 (比对顺序, new_count)。
+        """
+        fingerprints = {p: image_fingerprint(p, self.db["files"][p]) for p in file_list}
+        settings = self.compare_settings()
+        plan = self.db.get("compare_plan")
+        if (plan and plan["settings"] == settings and set(plan["order"]) == set(file_list)
+                and [fingerprints[p] for p in plan["order"]] == plan["fingerprints"]):
+            # 旧版把已找到的重复对存在数据库中，新版记录在比对日志里
+            found = self.pairs_from_paths(self.db.get("compare_found", []))
+            replayed = self.journal.replay()
+            if replayed:
+                self.log(f"从比对日志恢复 {len(replayed)} 个重复对")
+            found.update(self.pairs_from_paths((a, b, score) for (a, b), score in replayed.items()))
+            self.reset_found(found)
+            return plan["order"], plan["new_count"]
         
-        groups.sort(key=len, reverse=True)
+        compared = self.db.get("compared_files", {})
+        if compared and self.db.get("compare_settings") != settings:
+            self.log("比对方式、阈值或模型已改变，重新全量比对...")
+            compared = {}
+        old = [p for p in file_list if fingerprints[p] and compared.get(p) == fingerprints[p]]
+        old_set = set(old)
+        new = [p for p in file_list if p not in old_set]
+        order = new + old
         
-        return groups
+        self.db["compare_plan"] = {
+            "settings": settings,
+            "order": order,
+            "fingerprints": [fingerprints[p] for p in order],
+            "new_count": len(new),
+        }
+        self.reset_found()
+        self.journal.clear()
+        self.db.pop("compare_found", None)
+        save_db(self.db, ("compare_plan", "compare_found"))
+        self.save_compare_index(0)
+        return order, len(new)
+    
+    def _merge_previous(self, duplicates, unchanged):
+        """沿用上次结果中两端都未改动的重复对（副本对稍后重新展开）"""
+        unchanged = set(unchanged)
+        merged = self.pairs_from_paths(
+            (pair[0], pair[1], pair[2] if len(pair) > 2 else None) for pair in self.db.get("duplicates", [])
+            if len(pair) >= 2 and pair[0] in unchanged and pair[1] in unchanged)
+        merged.update(duplicates)
+        return merged
+    
+    def _expand_exact_copies(self, duplicates):
+        """把副本与其代表文件作为重复对加入结果"""
+        duplicates = dict(duplicates)
+        for p, info in self.db["files"].items():
+            rep = info.get("copy_of")
+            key = rep and self.pair_key(p, rep)
+            if key:
+                duplicates[key] = 1.0
+        return duplicates
+    
+    def _convert_to_groups(self, duplicates):
+        """将重复对（行号）转换为相似图片分组（路径）：比对中找到的重复对已随时并入并查集，这里只补上沿用和副本的重复对"""
+        for key in duplicates:
+            if key not in self.found_pairs:
+                self.groups.union(*key)
+        return self.current_groups()
     
     def stop_compare(self):
         """停止比对"""
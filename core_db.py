@@ -0,0 +1,470 @@
+"""工作区数据库模块（SQLite）"""
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections.abc import MutableMapping
+from core_persist import PersistService
+
+# ===================== 配置 =====================
+TEMP_FOLDER = "_image_temp"
+DB_PATH = os.path.join(TEMP_FOLDER, "db.sqlite")
+LEGACY_DB_PATH = os.path.join(TEMP_FOLDER, "db.json")
+JOURNAL_PATH = os.path.join(TEMP_FOLDER, "compare_journal.jsonl")
+JOURNAL_SYNC_PAIRS = 1000  # 攒够此数量的重复对后落盘
+JOURNAL_SYNC_SECONDS = 1.0  # 距上次落盘超过此时间后落盘
+DEFAULT_DB = {"state": "idle", "index": 0, "duplicates": [], "scan_processed": 0}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, record TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS features (path TEXT PRIMARY KEY, fingerprint TEXT);
+CREATE TABLE IF NOT EXISTS pairs (a TEXT NOT NULL, b TEXT NOT NULL, score REAL);
+CREATE TABLE IF NOT EXISTS groups (idx INTEGER PRIMARY KEY, members TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS progress (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+RECORD_FIELDS = ("id", "thumb", "dhash", "stat", "sha1", "partial", "copy_of")
+
+_RECORD_FIELDS = frozenset(RECORD_FIELDS)
+
+def plain(value):
+    """JSON 序列化时把记录和记录表转为普通字典"""
+    if isinstance(value, (FileRecord, FileTable)):
+        return value.to_dict()
+    raise TypeError(f"无法序列化 {type(value).__name__}")
+
+def dump(value):
+    """紧凑的 JSON 文本"""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=plain)
+
+def snapshot(value):
+    """浅拷贝列表和字典：交给后台写入后，调用方再原地修改也不影响这次保存"""
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+def pair_rows(pairs):
+    """重复对统一为 (a, b, 分数)，旧版只有 [a, b] 的分数记为 None"""
+    return [(p[0], p[1], p[2] if len(p) > 2 else None) for p in pairs or []]
+
+class FileRecord:
+    """一张图片的记录，按字典方式读写；常用字段存在 __slots__ 中，未设置的字段视为不存在"""
+
+    __slots__ = RECORD_FIELDS + ("extra",)
+
+    def __init__(self, data=()):
+        self.extra = None
+        for key, value in dict(data).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in _RECORD_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _RECORD_FIELDS:
+            # 缩略图键与编号相同时共用同一个字符串
+            if key == "thumb" and value == getattr(self, "id", None):
+                value = self.id
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _RECORD_FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in _RECORD_FIELDS:
+            return hasattr(self, key)
+        return bool(self.extra) and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [k for k in RECORD_FIELDS if hasattr(self, k)] + list(self.extra or ())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, FileRecord):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"FileRecord({self.to_dict()!r})"
+
+def split_path(path):
+    """拆成 (目录前缀, 文件名)，目录前缀带结尾分隔符，两者拼接即为原路径"""
+    cut = max(path.rfind("/"), path.rfind("\\") if os.sep == "\\" else -1) + 1
+    return path[:cut], path[cut:]
+
+class FileTable(MutableMapping):
+    """图片记录表：路径 → FileRecord，每张图片对应一个整数行号
+
+    路径拆成 目录编号 + 文件名 保存，同一目录的前缀只存一份。行号在本次运行内不变（删除的行留空，
+    下次加载时重新紧凑编号），比对和分组按行号进行，只在输出时换回路径。
+    增删改过的路径记录在 dirty 中，保存时只写这些行；直接修改记录内部字段后需调用 touch(路径)。
+    """
+
+    def __init__(self, items=()):
+        self.dirs = []  # 目录编号 → 目录前缀
+        self.dir_ids = {}  # 目录前缀 → 目录编号
+        self.by_dir = []  # 目录编号 → {文件名: 行号}
+        self.row_dir = array("i")  # 行号 → 目录编号
+        self.row_name = []  # 行号 → 文件名
+        self.records = []  # 行号 → FileRecord，已删除为 None
+        self.count = 0
+        self.dirty = set()
+        for path, record in dict(items).items():
+            self[path] = record
+
+    def row_of(self, path, default=None):
+        """路径对应的行号，不存在返回 default"""
+        folder, name = split_path(path)
+        d = self.dir_ids.get(folder)
+        if d is None:
+            return default
+        return self.by_dir[d].get(name, default)
+
+    def path_of(self, row):
+        """行号对应的路径"""
+        return self.dirs[self.row_dir[row]] + self.row_name[row]
+
+    def __getitem__(self, path):
+        row = self.row_of(path)
+        if row is None:
+            raise KeyError(path)
+        return self.records[row]
+
+    def __setitem__(self, path, record):
+        if not isinstance(record, FileRecord):
+            record = FileRecord(record)
+        row = self.row_of(path)
+        if row is None:
+            folder, name = split_path(path)
+            d = self.dir_ids.get(folder)
+            if d is None:
+                d = self.dir_ids[folder] = len(self.dirs)
+                self.dirs.append(folder)
+                self.by_dir.append({})
+            row = self.by_dir[d][name] = len(self.records)
+            self.row_dir.append(d)
+            self.row_name.append(name)
+            self.records.append(record)
+            self.count += 1
+        else:
+            self.records[row] = record
+        self.dirty.add(path)
+
+    def __delitem__(self, path):
+        folder, name = split_path(path)
+        d = self.dir_ids.get(folder)
+        row = None if d is None else self.by_dir[d].pop(name, None)
+        if row is None:
+            raise KeyError(path)
+        self.records[row] = None
+        self.count -= 1
+        self.dirty.add(path)
+
+    def __contains__(self, path):
+        return self.row_of(path) is not None
+
+    def __iter__(self):
+        for row, record in enumerate(self.records):
+            if record is not None:
+                yield self.path_of(row)
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        return [(self.path_of(row), record) for row, record in enumerate(self.records) if record is not None]
+
+    def values(self):
+        return [record for record in self.records if record is not None]
+
+    def to_dict(self):
+        return {path: record.to_dict() for path, record in self.items()}
+
+    def touch(self, path):
+        """标记记录已在原处修改"""
+        self.dirty.add(path)
+
+    def take_changes(self):
+        """取出改动过的记录 {路径: 记录或 None(已删除)}，之后再改动的路径重新记录"""
+        paths = list(self.dirty)
+        self.dirty.difference_update(paths)
+        # 先清除标记再取值：取值之后的改动会重新标记，不会漏掉
+        return {path: self.get(path) for path in paths}
+
+class WorkspaceDB:
+    """工作区数据库：WAL 模式的 SQLite，图片记录逐行增量写入
+
+    files 表每张图片一行；features（上次比对的指纹）、pairs（重复对）、groups（相似组）
+    只在内容变化时整表重写；其余字段逐项存入 progress 表，值不变时不写。
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+        self._saved = {}  # 各字段上次写入内容的摘要
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def load(self):
+        """读取整个数据库为字典，图片记录放在 FileTable 中"""
+        with self.lock:
+            cur = self.conn.cursor()
+            db = dict(DEFAULT_DB)
+            for key, value in cur.execute("SELECT key, value FROM progress"):
+                db[key] = json.loads(value)
+            files = db["files"] = FileTable()
+            for p, r in cur.execute("SELECT path, record FROM files ORDER BY rowid"):
+                files[p] = json.loads(r)
+            files.dirty.clear()
+            db["duplicates"] = [[a, b, s] for a, b, s in cur.execute("SELECT a, b, score FROM pairs ORDER BY rowid")]
+            groups = [json.loads(m) for (m,) in cur.execute("SELECT members FROM groups ORDER BY idx")]
+            if groups:
+                db["duplicate_groups"] = groups
+            compared = dict(cur.execute("SELECT path, fingerprint FROM features"))
+            if compared:
+                db["compared_files"] = compared
+            self._saved = {key: self._digest(value) for key, value in db.items() if key != "files"}
+            return db
+
+    def _digest(self, value):
+        return hashlib.sha1(dump(value).encode('utf-8')).digest()
+
+    def collect(self, db, keys=None):
+        """在调用线程取出待保存的改动：记录和字段取浅拷贝，序列化和写入留给 write()
+
+        改动为 {"files": {路径: 记录或 None}, "fields": {字段: 值或 None}, "reset": 是否重写记录表,
+        "full": 是否为全部字段}。
+        """
+        files = db.get("files")
+        reset = not isinstance(files, FileTable)
+        if reset:
+            # 整个替换过的记录表：全部重写，之后改为增量跟踪
+            files = db["files"] = FileTable(files or {})
+        full = keys is None
+        fields = {key: snapshot(db.get(key)) for key in (db if full else keys) if key != "files"}
+        rows = {path: None if record is None else record.to_dict() for path, record in files.take_changes().items()}
+        return {"files": rows, "fields": fields, "reset": reset, "full": full}
+
+    @staticmethod
+    def merge(old, new):
+        """合并先后两批改动，后者优先"""
+        if new["full"]:
+            # 全量保存中没有的字段已被删除，不能让之前排队的旧值写回去
+            fields = dict.fromkeys(old["fields"])
+            fields.update(new["fields"])
+        else:
+            fields = dict(old["fields"], **new["fields"])
+        if new["reset"]:
+            return dict(new, fields=fields, full=old["full"] or new["full"])
+        return {"files": dict(old["files"], **new["files"]), "fields": fields,
+                "reset": old["reset"], "full": old["full"] or new["full"]}
+
+    @staticmethod
+    def size(changes):
+        return len(changes["files"]) + len(changes["fields"])
+
+    def write(self, changes):
+        """在一个事务中写入改动：记录逐行写入，字段内容有变化时才写"""
+        with self.lock, self.conn:
+            if changes["reset"]:
+                self.conn.execute("DELETE FROM files")
+            rows = changes["files"]
+            self.conn.executemany("INSERT OR REPLACE INTO files (path, record) VALUES (?, ?)",
+                                  [(p, dump(r)) for p, r in rows.items() if r is not None])
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p, r in rows.items() if r is None])
+
+            fields = dict(changes["fields"])
+            if changes["full"]:
+                # 全量保存时数据库中多出的字段已被删除
+                for key in self._saved:
+                    fields.setdefault(key, None)
+            for key, value in fields.items():
+                if value is None:
+                    if self._saved.pop(key, None) is not None:
+                        self._write(key, None)
+                    continue
+                digest = self._digest(value)
+                if self._saved.get(key) != digest:
+                    self._write(key, value)
+                    self._saved[key] = digest
+
+    def save(self, db, keys=None):
+        """同步保存：写入有改动的图片记录，以及 keys 中（None 表示全部）内容有变化的字段"""
+        self.write(self.collect(db, keys))
+
+    def _write(self, key, value):
+        """整体写入一个字段，value 为 None 表示删除"""
+        if key == "duplicates":
+            self.conn.execute("DELETE FROM pairs")
+            self.conn.executemany("INSERT INTO pairs (a, b, score) VALUES (?, ?, ?)", pair_rows(value))
+        elif key == "duplicate_groups":
+            self.conn.execute("DELETE FROM groups")
+            self.conn.executemany("INSERT INTO groups (idx, members) VALUES (?, ?)",
+                                  [(i, dump(g)) for i, g in enumerate(value or [])])
+        elif key == "compared_files":
+            self.conn.execute("DELETE FROM features")
+            self.conn.executemany("INSERT INTO features (path, fingerprint) VALUES (?, ?)", (value or {}).items())
+        elif value is None:
+            self.conn.execute("DELETE FROM progress WHERE key = ?", (key,))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO progress (key, value) VALUES (?, ?)", (key, dump(value)))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class PairJournal:
+    """比对日志：找到的重复对逐行追加，成批 fsync，比对中断后续比时重放，比对完成后删除"""
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self._file = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def replay(self):
+        """读取已落盘的重复对 {(a, b): score}，截掉中断时写了一半的末行"""
+        pairs = {}
+        if not os.path.exists(self.path):
+            return pairs
+        self.close()
+        valid = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    a, b, score = json.loads(line)
+                except ValueError:
+                    break
+                pairs[(a, b)] = score
+                valid += len(line)
+        if valid < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid)
+        return pairs
+
+    def append(self, a, b, score):
+        """追加一个重复对，攒够一批或超时后落盘"""
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(dump([a, b, score]) + "\n")
+        self._pending += 1
+        if self._pending >= JOURNAL_SYNC_PAIRS or time.monotonic() - self._last_sync >= JOURNAL_SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        """把已追加的重复对写入磁盘（保存比对进度前调用，保证进度之前的结果都已落盘）"""
+        if self._file is not None and self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def clear(self):
+        """删除日志（开始新的比对计划或结果已写入数据库时）"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def migrate_legacy_db(workspace, path=LEGACY_DB_PATH):
+    """把旧版 db.json 导入数据库（只执行一次，原文件改名为 .bak 保留），返回是否导入
+
+    导入失败时抛出异常，db.json 保持原样，下次启动重新导入。
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        db = json.load(f)
+    db.setdefault("files", {})
+    for key in ("last_file_list", "last_file_count"):
+        db.pop(key, None)
+    workspace.save(db)
+    os.replace(path, path + ".bak")
+    return True
+
+_workspaces = {}
+_services = {}
+_workspaces_lock = threading.Lock()
+
+def workspace_db(path=DB_PATH):
+    """进程内共享的数据库连接，首次打开时导入旧版 db.json"""
+    with _workspaces_lock:
+        if path not in _workspaces:
+            workspace = WorkspaceDB(path)
+            legacy_path = os.path.join(os.path.dirname(path), "db.json")
+            try:
+                if migrate_legacy_db(workspace, legacy_path):
+                    print("已将 db.json 导入 SQLite 数据库")
+            except Exception as e:
+                # 不能带着空数据库继续运行：交给调用方提示，db.json 保持原样
+                workspace.close()
+                raise RuntimeError(f"导入旧版数据库 {legacy_path} 失败（原文件未改动）: {str(e)}") from e
+            _workspaces[path] = workspace
+
+        return _workspaces[path]
+
+def workspace_persist(path=DB_PATH):
+    """数据库的共享后台持久化服务，save_db 提交的改动由它在后台写入"""
+    workspace = workspace_db(path)
+    with _workspaces_lock:
+        if path not in _services:
+            _services[path] = PersistService(workspace.write, workspace.merge, workspace.size)
+        return _services[path]
+
+def close_workspace_db(path=DB_PATH):
+    """写完未保存的改动后关闭共享连接（删除缓存目录前调用）"""
+    with _workspaces_lock:
+        service = _services.pop(path, None)
+        workspace = _workspaces.pop(path, None)
+    if service is not None:
+        service.close()
+    if workspace is not None:
+        workspace.close()
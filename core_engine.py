@@ -0,0 +1,270 @@
+"""批量比对引擎"""
+import os
+import math
+import hashlib
+import importlib
+from contextlib import contextmanager
+import numpy as np
+from core_features import PUBLISH_BATCH, attach_features
+
+# ===================== 配置 =====================
+# 推理后端名 → (模块, sim 头类)
+BACKENDS = {
+    "torch": ("core_torch", "TorchSimHead"),
+    "torch_jit": ("core_torch", "TracedSimHead"),
+    "numpy": ("core_numpy", "NumpySimHead"),
+}
+PRUNE_GROUPS = 64  # 剪枝统计量的特征分段数
+PRUNE_MARGIN = 1e-2  # 剪枝上界的数值安全余量（logit 空间）
+PRUNE_DIST_SLACK = 1e-4  # Gram 矩阵求距离时的相对误差余量
+PRUNE_PROBE_PAIRS = 200000  # 试探这么多组合后评估剪枝率
+PRUNE_MIN_RATE = 0.05  # 剪枝率低于此值时自动停用
+PRUNE_STATS = ("norms", "Q", "P_total", "Q_total", "P")  # 每张图片的剪枝统计量（P 最后落盘，存在即完整）
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")  # 子进程启动时读取的 BLAS 线程数
+
+class Backend:
+    """推理后端：模块提供 load_model / pick_device / get_threads / set_threads / extract_batch，SimHead 为所选的 sim 头类"""
+
+    def __init__(self, name):
+        module_name, head_name = BACKENDS[name]
+        self.name = name
+        self.module = importlib.import_module(module_name)
+        self.SimHead = getattr(self.module, head_name)
+
+    def __getattr__(self, attr):
+        return getattr(self.module, attr)
+
+def load_backend(name):
+    """按名称加载推理后端（torch 未安装时加载 torch 系列后端会抛出 ImportError）"""
+    if name not in BACKENDS:
+        raise ValueError(f"未知的推理后端: {name}")
+    return Backend(name)
+
+# ===================== 批量比对引擎 =====================
+def tile_block_size(dim, memory_mb):
+    """按内存预算计算分块边长，一个块的差值矩阵 (b*b*dim float32) 不超过预算"""
+    pairs = max(1, int(memory_mb * 1024 * 1024) // (dim * 4))
+    return max(1, math.isqrt(pairs))
+
+def rows_done_pairs(rows, n):
+    """前 rows 行（行优先上三角）包含的组合数"""
+    return rows * (2 * n - rows - 1) // 2
+
+def index_to_pair(k, n):
+    """线性序号反解为组合 (i, j)，O(1)"""
+    b = 2 * n - 1
+    i = (b - math.isqrt(b * b - 8 * k)) // 2
+    # 整数开方的边界修正
+    while i > 0 and rows_done_pairs(i, n) > k:
+        i -= 1
+    while rows_done_pairs(i + 1, n) <= k:
+        i += 1
+    return i, k - rows_done_pairs(i, n) + i + 1
+
+class PruningBounds:
+    """sim 头输出的可证明上界，用于跳过不可能达到阈值的组合
+
+    特征是 ReLU 输出（非负），d = |fi - fj|。把第一层权重拆成正负两部分 W+ / W-，
+    并把特征维度切成若干段，对每张图预先计算每段的投影 P = F·W+^T、Q = F·W-^T 和 ||f||^2，则
+        sum_g |P_ig - P_jg| <= W+·d <= min(P_i + P_j, ||W+|| · ||fi - fj||)
+    （W- 同理），由此得到每个隐藏单元预激活的区间，再按第二层权重符号取上界，
+    即得到 logit 的上界。上界低于阈值的组合一定不是重复，跳过不会改变结果。
+    绑定到共享特征矩阵时统计量写入旁边的 .npy 文件，传给子进程时只传文件名，由子进程内存映射挂载。
+    """
+
+    def __init__(self, weights, threshold, groups=PRUNE_GROUPS, margin=PRUNE_MARGIN):
+        W1, b1, w2, b2 = weights
+        hidden, dim = W1.shape
+        self.groups = groups
+        self.key = hashlib.sha1(np.ascontiguousarray(W1, dtype=np.float32).tobytes()).hexdigest()[:16]
+        self.Wp = np.maximum(W1, 0).reshape(hidden, groups, dim // groups)
+        self.Wn = np.maximum(-W1, 0).reshape(hidden, groups, dim // groups)
+        self.wp_norm = np.linalg.norm(np.maximum(W1, 0), axis=1)
+        self.wn_norm = np.linalg.norm(np.maximum(-W1, 0), axis=1)
+        self.b1 = b1.astype(np.float64)
+        self.w2 = w2.astype(np.float64)
+        self.b2 = float(b2)
+        if threshold <= 0:
+            self.limit = -np.inf
+        elif threshold >= 1:
+            self.limit = np.inf
+        else:
+            self.limit = math.log(threshold / (1 - threshold)) - margin
+        self.P = self.Q = self.norms = None
+        self.shared = None
+        self.active = True
+        self.checked = 0
+        self.pruned = 0
+
+    def bind(self, feats, batch=PUBLISH_BATCH, path=None):
+        """预计算每张图片的分段投影统计量
+
+        path 为 feats 对应的共享矩阵文件时，统计量落盘到旁边并以内存映射挂载，
+        同一矩阵和权重的统计量已存在时直接挂载。
+        """
+        if path is not None:
+            self.shared = f"{path[:-len('.npy')]}.bounds_{self.key}"
+            if not os.path.exists(self._stat_path("P")):
+                self._compute(feats, batch, self.shared)
+            self._attach()
+        else:
+            self._compute(feats, batch)
+        # 只保留统计量，便于传给子进程
+        self.Wp = self.Wn = None
+
+    def _stat_path(self, name, prefix=None):
+        return f"{prefix or self.shared}.{name}.npy"
+
+    def _compute(self, feats, batch, prefix=None):
+        n = len(feats)
+        hidden = len(self.b1)
+        shapes = {"norms": ((n,), np.float64), "P": ((n, hidden, self.groups), np.float32),
+                  "Q": ((n, hidden, self.groups), np.float32), "P_total": ((n, hidden), np.float64),
+                  "Q_total": ((n, hidden), np.float64)}
+        if prefix is None:
+            stats = {name: np.zeros(shape, dtype=dtype) for name, (shape, dtype) in shapes.items()}
+        else:
+            stats = {name: np.lib.format.open_memmap(self._stat_path(name, prefix) + ".tmp", mode='w+',
+                                                     dtype=dtype, shape=shape)
+                     for name, (shape, dtype) in shapes.items()}
+        P, Q = stats["P"], stats["Q"]
+        for start in range(0, n, batch):
+            f = np.asarray(feats[start:start + batch], dtype=np.float64).reshape(-1, self.groups, self.Wp.shape[2])
+            P[start:start + batch] = np.einsum('ngm,kgm->nkg', f, self.Wp)
+            Q[start:start + batch] = np.einsum('ngm,kgm->nkg', f, self.Wn)
+            stats["norms"][start:start + batch] = np.einsum('ngm,ngm->n', f, f)
+            stats["P_total"][start:start + batch] = P[start:start + batch].sum(axis=2, dtype=np.float64)
+            stats["Q_total"][start:start + batch] = Q[start:start + batch].sum(axis=2, dtype=np.float64)
+        if prefix is None:
+            for name, value in stats.items():
+                setattr(self, name, value)
+            return
+        for value in stats.values():
+            value.flush()
+        del P, Q, value, stats
+        # 先释放映射再改名（Windows 下不能替换已映射的文件）
+        for name in PRUNE_STATS:
+            os.replace(self._stat_path(name, prefix) + ".tmp", self._stat_path(name, prefix))
+
+    def _attach(self):
+        for name in PRUNE_STATS:
+            setattr(self, name, np.load(self._stat_path(name), mmap_mode='r'))
+
+    def __getstate__(self):
+        # 共享统计量不随对象序列化，子进程按文件名重新挂载
+        state = dict(self.__dict__)
+        if self.shared is not None:
+            for name in PRUNE_STATS:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            self._attach()
+
+    def upper_logit(self, i0, i1, j0, j1, gram):
+        """整块组合的 logit 上界"""
+        ni = self.norms[i0:i1, None]
+        nj = self.norms[None, j0:j1]
+        dist = np.sqrt(np.maximum(ni + nj - 2 * gram, 0) + PRUNE_DIST_SLACK * (ni + nj))[..., None]
+        lo_p = np.abs(self.P[i0:i1, None] - self.P[None, j0:j1]).sum(axis=3, dtype=np.float64)
+        lo_q = np.abs(self.Q[i0:i1, None] - self.Q[None, j0:j1]).sum(axis=3, dtype=np.float64)
+        up_p = np.minimum(self.P_total[i0:i1, None] + self.P_total[None, j0:j1], self.wp_norm * dist)
+        up_q = np.minimum(self.Q_total[i0:i1, None] + self.Q_total[None, j0:j1], self.wn_norm * dist)
+        hi = up_p - lo_q + self.b1
+        lo = lo_p - up_q + self.b1
+        hidden = np.where(self.w2 > 0, np.maximum(hi, 0), np.maximum(lo, 0))
+        return hidden @ self.w2 + self.b2
+
+    def survivors(self, i0, i1, j0, j1, gram, valid):
+        """过滤掉上界达不到阈值的组合；剪枝率过低时自动停用以免白白增加开销"""
+        keep = valid & (self.upper_logit(i0, i1, j0, j1, gram) >= self.limit)
+        self.checked += int(valid.sum())
+        self.pruned += int(valid.sum()) - int(keep.sum())
+        if self.checked >= PRUNE_PROBE_PAIRS and self.pruned < PRUNE_MIN_RATE * self.checked:
+            self.active = False
+        return keep
+
+def iter_tiled_pairs(head, n, threshold, block, start=0, stop=None, bounds=None):
+    """按 (i块 × j块) 遍历线性序号 [start, stop) 覆盖的上三角，
+    逐块产出 (i0, i1, j0, j1, 组合数, 实际计算数, 超过阈值的 [(i, j, score)])"""
+    total = n * (n - 1) // 2
+    stop = total if stop is None else min(stop, total)
+    if start >= stop:
+        return
+    first_i, first_j = index_to_pair(start, n)
+    last_i, last_j = index_to_pair(stop - 1, n)
+    for i0 in range(first_i, last_i + 1, block):
+        i1 = min(i0 + block, last_i + 1)
+        for j0 in range(i0, n, block):
+            j1 = min(j0 + block, n)
+            rows = np.arange(i0, i1)[:, None]
+            cols = np.arange(j0, j1)[None, :]
+            valid = cols > rows
+            # 首尾行只取范围内的部分
+            if i0 == first_i:
+                valid &= ~((rows == first_i) & (cols < first_j))
+            if i1 == last_i + 1:
+                valid &= ~((rows == last_i) & (cols > last_j))
+            count = int(valid.sum())
+            if count and bounds is not None and bounds.active:
+                valid = bounds.survivors(i0, i1, j0, j1, head.tile_gram(i0, i1, j0, j1), valid)
+            evaluated = int(valid.sum())
+            if evaluated == 0:
+                yield i0, i1, j0, j1, count, 0, []
+                continue
+            if evaluated * 2 >= valid.size:
+                scores = head.tile_scores(i0, i1, j0, j1)
+                ii, jj = np.nonzero(valid & (scores >= threshold))
+                found_scores = scores[ii, jj]
+            else:
+                # 剪枝后剩余较少，只计算剩余组合
+                ii, jj = np.nonzero(valid)
+                scores = head.pair_scores(ii + i0, jj + j0)
+                keep = scores >= threshold
+                ii, jj, found_scores = ii[keep], jj[keep], scores[keep]
+            found = list(zip((ii + i0).tolist(), (jj + j0).tolist(), found_scores.tolist()))
+            yield i0, i1, j0, j1, count, evaluated, found
+
+# ===================== 多进程比对 =====================
+_worker_state = {}
+
+@contextmanager
+def thread_env(threads):
+    """临时设置 BLAS 线程数环境变量（子进程启动时读取），退出时恢复原值，不影响本进程之后启动的程序"""
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+def init_compare_worker(backend, model_path, matrix_path, threshold, block, threads, bounds=None):
+    """进程池初始化：每个进程只加载一次模型，并零拷贝挂载共享特征矩阵
+
+    只导入所选后端的模块，NumPy 后端的子进程不会加载 torch。
+    """
+    backend = load_backend(backend)
+    backend.set_threads(threads)
+    feats = attach_features(matrix_path)
+    head = backend.SimHead(backend.load_model(model_path))
+    head.bind(feats)
+    _worker_state.update(head=head, n=len(feats), threshold=threshold, block=block, bounds=bounds)
+
+def compare_range_worker(task):
+    """比对一段连续的线性序号 [start, stop)"""
+    start, stop = task
+    found = []
+    evaluated = 0
+    for *_, tile_evaluated, tile_found in iter_tiled_pairs(
+            _worker_state["head"], _worker_state["n"], _worker_state["threshold"],
+            _worker_state["block"], start, stop, _worker_state["bounds"]):
+        evaluated += tile_evaluated
+        found.extend(tile_found)
+    return start, stop, evaluated, found
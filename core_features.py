@@ -0,0 +1,328 @@
+"""特征缓存模块"""
+import os
+import json
+import hashlib
+import cv2
+import numpy as np
+from core_thumbs import thumb_store
+from core_persist import atomic_write_json
+
+# ===================== 配置 =====================
+TEMP_FOLDER = "_image_temp"
+FEATURE_FOLDER = os.path.join(TEMP_FOLDER, "features")
+FEATURE_DIM = 16 * 32 * 32
+PUBLISH_BATCH = 1024
+COMPACT_RATIO = 0.3  # 废弃行超过总行数的此比例时压缩
+FEATURE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.uint8}
+INT8_LEVELS = 255  # 特征为 ReLU 输出（非负），8 位编码取 0~255
+IMG_INPUT_SIZE = 128
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    """计算文件内容哈希（用于区分A/B模型）"""
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+def image_fingerprint(path, info):
+    """计算图片指纹：原图路径 + 缩略图大小与写入时间"""
+    stat = thumb_store().stat(info.get("thumb", ""))
+    if stat is None:
+        return None
+    key = f"{path}|{stat[0]}|{stat[1]}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def model_input(img):
+    """缩略图像素 (BGR / BGRA / 灰度) 转为模型输入：IMG_INPUT_SIZE x IMG_INPUT_SIZE x 3 的 RGB 数组"""
+    if len(img.shape) == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    else:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return cv2.resize(img, (IMG_INPUT_SIZE, IMG_INPUT_SIZE))
+
+def encode_features(feats, encoding="float32"):
+    """按编码压缩特征，返回 (编码矩阵, 每行缩放系数或 None)"""
+    feats = np.asarray(feats, dtype=np.float32)
+    if encoding == "float32":
+        return feats, None
+    if encoding == "float16":
+        return feats.astype(np.float16), None
+    feats = np.maximum(feats, 0)
+    scales = feats.max(axis=1) / INT8_LEVELS
+    scales[scales == 0] = 1
+    codes = np.rint(feats / scales[:, None]).astype(np.uint8)
+    return codes, scales.astype(np.float32)
+
+def decode_features(codes, scales=None):
+    """编码矩阵还原为 float32"""
+    out = np.asarray(codes, dtype=np.float32)
+    if scales is not None:
+        scales = np.asarray(scales, dtype=np.float32)
+        out = out * (scales[..., None] if out.ndim > 1 else scales)
+    return out
+
+class FeatureMatrix:
+    """特征矩阵，按压缩编码保存，切片时才解码为 float32"""
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        return decode_features(self.codes[key], None if self.scales is None else self.scales[key])
+
+    @property
+    def dim(self):
+        return self.codes.shape[1]
+
+class FeatureStore:
+    """持久化特征库，按图片指纹、模型哈希和编码方式索引"""
+
+    def __init__(self, model_hash, folder=FEATURE_FOLDER, dim=FEATURE_DIM, encoding="float32"):
+        if encoding not in FEATURE_DTYPES:
+            raise ValueError(f"不支持的特征编码: {encoding}")
+        self.model_hash = model_hash
+        self.folder = folder
+        self.dim = dim
+        self.encoding = encoding
+        self.dtype = np.dtype(FEATURE_DTYPES[encoding])
+        self.name = model_hash if encoding == "float32" else f"{model_hash}_{encoding}"
+        self.data_path = os.path.join(folder, f"feat_{self.name}.bin")
+        self.scale_path = os.path.join(folder, f"feat_{self.name}.scale")
+        self.index_path = os.path.join(folder, f"feat_{self.name}.json")
+        self.index = {}
+        self._data = None
+        self._scales = None
+        self._load_index()
+
+    def _load_index(self):
+        """加载索引，数据文件与索引不一致时丢弃"""
+        os.makedirs(self.folder, exist_ok=True)
+        try:
+            if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                rows = self._row_count()
+                if meta.get("dim") == self.dim:
+                    self.index = {k: v for k, v in meta.get("rows", {}).items() if v < rows}
+        except Exception as e:
+            print(f"读取特征索引失败，重新建立: {str(e)}")
+            self.index = {}
+
+    def _row_count(self):
+        """数据文件中完整写入的行数"""
+        rows = os.path.getsize(self.data_path) // (self.dim * self.dtype.itemsize)
+        if self.encoding == "int8":
+            rows = min(rows, os.path.getsize(self.scale_path) // 4 if os.path.exists(self.scale_path) else 0)
+        return rows
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, fingerprints):
+        """返回每个指纹对应的行号，不存在为-1"""
+        return np.array([self.index.get(fp, -1) if fp else -1 for fp in fingerprints], dtype=np.int64)
+
+    def append(self, fingerprints, feats):
+        """追加特征到数据文件"""
+        feats = np.asarray(feats, dtype=np.float32).reshape(len(fingerprints), self.dim)
+        codes, scales = encode_features(feats, self.encoding)
+        self._data = self._scales = None
+        if os.path.exists(self.data_path):
+            start = self._row_count()
+            # 截掉上次中断时写了一半的行
+            with open(self.data_path, 'r+b') as f:
+                f.truncate(start * self.dim * self.dtype.itemsize)
+        else:
+            start = 0
+        if scales is not None:
+            with open(self.scale_path, 'r+b' if os.path.exists(self.scale_path) else 'wb') as f:
+                f.truncate(start * 4)
+                f.seek(start * 4)
+                scales.tofile(f)
+        with open(self.data_path, 'ab') as f:
+            np.ascontiguousarray(codes).tofile(f)
+        for offset, fp in enumerate(fingerprints):
+            self.index[fp] = start + offset
+
+    def _open(self):
+        """内存映射数据文件"""
+        if self._data is None:
+            rows = self._row_count()
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode='r', shape=(rows, self.dim))
+            if self.encoding == "int8":
+                self._scales = np.memmap(self.scale_path, dtype=np.float32, mode='r', shape=(rows,))
+
+    def matrix(self, row_ids):
+        """按行号读取特征，保持压缩编码"""
+        self._open()
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        scales = None if self._scales is None else np.asarray(self._scales[row_ids])
+        return FeatureMatrix(np.asarray(self._data[row_ids]), scales)
+
+    def publish(self, row_ids):
+        """按顺序把指定行写入 .npy 内存映射文件，供多进程零拷贝共享"""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        digest = hashlib.sha1(row_ids.tobytes()).hexdigest()[:16]
+        path = os.path.join(self.folder, f"run_{self.name}_{digest}.npy")
+        if os.path.exists(path):
+            return path
+        
+        # 清理旧的共享矩阵
+        for name in os.listdir(self.folder):
+            if name.startswith("run_") and name.endswith(".npy"):
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
+        
+        # 缩放系数先落盘，矩阵文件最后改名，矩阵存在即说明整份数据完整
+        self._open()
+        if self._scales is not None:
+            np.save(scale_path_for(path), np.asarray(self._scales[row_ids]))
+        tmp_path = path + ".tmp"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype, shape=(len(row_ids), self.dim))
+        for start in range(0, len(row_ids), PUBLISH_BATCH):
+            out[start:start + PUBLISH_BATCH] = self._data[row_ids[start:start + PUBLISH_BATCH]]
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        return path
+
+    def save(self):
+        """保存索引（先写临时文件再替换）"""
+        atomic_write_json(self.index_path, {"dim": self.dim, "rows": self.index})
+
+    def retain(self, fingerprints):
+        """只保留指定指纹的行，其余行成为废弃数据"""
+        keep = set(fingerprints)
+        self.index = {fp: row for fp, row in self.index.items() if fp in keep}
+
+    def compact(self, force=False):
+        """废弃行超过比例时只把有效行按原顺序重写，返回是否执行"""
+        self._data = self._scales = None
+        total = self._row_count() if os.path.exists(self.data_path) else 0
+        if total == 0 or (not force and total - len(self.index) <= total * COMPACT_RATIO):
+            return False
+        files = [(self.data_path, self.dim * self.dtype.itemsize)]
+        if self.encoding == "int8":
+            files.append((self.scale_path, 4))
+        self.index = rewrite_rows(files, self.index, self.index_path)
+        self.save()
+        return True
+
+class InputStore:
+    """模型输入缓存：扫描时写入 uint8 RGB 数组，按图片指纹索引，提取特征时内存映射读取，免去解码缩略图"""
+
+    def __init__(self, folder=FEATURE_FOLDER, size=IMG_INPUT_SIZE):
+        self.folder = folder
+        self.size = size
+        self.row_bytes = size * size * 3
+        self.data_path = os.path.join(folder, "inputs.bin")
+        self.index_path = os.path.join(folder, "inputs.json")
+        self.index = {}
+        self._data = None
+        self._rows = None
+        self._load_index()
+
+    def _load_index(self):
+        """加载索引，数据文件与索引不一致时丢弃"""
+        os.makedirs(self.folder, exist_ok=True)
+        try:
+            if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                rows = self._row_count()
+                if meta.get("size") == self.size:
+                    self.index = {k: v for k, v in meta.get("rows", {}).items() if v < rows}
+        except Exception as e:
+            print(f"读取模型输入索引失败，重新建立: {str(e)}")
+            self.index = {}
+
+    def _row_count(self):
+        """数据文件中完整写入的行数"""
+        if not os.path.exists(self.data_path):
+            return 0
+        return os.path.getsize(self.data_path) // self.row_bytes
+
+    def append(self, fingerprint, img):
+        """追加一张图片的模型输入（多线程调用时由调用方加锁）"""
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if img.shape != (self.size, self.size, 3):
+            raise ValueError(f"模型输入尺寸不符: {img.shape}")
+        self._data = None
+        if self._rows is None:
+            self._rows = self._row_count()
+            # 截掉上次中断时写了一半的行
+            if os.path.exists(self.data_path):
+                with open(self.data_path, 'r+b') as f:
+                    f.truncate(self._rows * self.row_bytes)
+        with open(self.data_path, 'ab') as f:
+            img.tofile(f)
+        self.index[fingerprint] = self._rows
+        self._rows += 1
+
+    def lookup(self, fingerprints):
+        """返回每个指纹对应的行号，不存在为-1"""
+        return np.array([self.index.get(fp, -1) if fp else -1 for fp in fingerprints], dtype=np.int64)
+
+    def read(self, row_ids):
+        """按行号读取模型输入 (k, size, size, 3) uint8"""
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r',
+                                   shape=(self._row_count(), self.size, self.size, 3))
+        return np.asarray(self._data[np.asarray(row_ids, dtype=np.int64)])
+
+    def save(self):
+        """保存索引（先写临时文件再替换）"""
+        atomic_write_json(self.index_path, {"size": self.size, "rows": self.index})
+
+    def retain(self, fingerprints):
+        """只保留指定指纹的行，其余行成为废弃数据"""
+        keep = set(fingerprints)
+        self.index = {fp: row for fp, row in self.index.items() if fp in keep}
+
+    def compact(self, force=False):
+        """废弃行超过比例时只把有效行按原顺序重写，返回是否执行"""
+        self._data = self._rows = None
+        total = self._row_count()
+        if total == 0 or (not force and total - len(self.index) <= total * COMPACT_RATIO):
+            return False
+        self.index = rewrite_rows([(self.data_path, self.row_bytes)], self.index, self.index_path)
+        self.save()
+        return True
+
+def rewrite_rows(files, index, index_path):
+    """把索引中的行按原顺序重写到各数据文件，返回新索引 {指纹: 行号}
+
+    files 为 [(数据文件, 每行字节数)]，所有临时文件写完后先删旧索引再替换数据文件，
+    中途中断只会丢失缓存，不会让旧索引指向错位的行。
+    """
+    order = sorted(index, key=index.get)
+    for path, row_bytes in files:
+        with open(path, 'rb') as src, open(path + ".tmp", 'wb') as dst:
+            for fp in order:
+                src.seek(index[fp] * row_bytes)
+                dst.write(src.read(row_bytes))
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    for path, _ in files:
+        os.replace(path + ".tmp", path)
+    return {fp: row for row, fp in enumerate(order)}
+
+def scale_path_for(path):
+    """共享矩阵对应的缩放系数文件"""
+    return path[:-len(".npy")] + ".scale.npy"
+
+def attach_features(path):
+    """挂载共享特征矩阵（写时复制映射，各进程共享同一份页缓存）"""
+    scale_path = scale_path_for(path)
+    scales = np.load(scale_path) if os.path.exists(scale_path) else None
+    return FeatureMatrix(np.load(path, mmap_mode='c'), scales)
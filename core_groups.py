@@ -0,0 +1,93 @@
+"""相似分组模块"""
+
+class DisjointSet:
+    """并查集：整数编号的重复对随时并入，路径压缩 + 按秩合并
+
+    每个根保存自己的成员列表（合并时短列表并入长列表），任何时候都能直接取出当前分组。
+    discard() 把编号移出所在分组，分组本身不会因此拆开。
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.rank = {}
+        self.members = {}  # 根 → 成员列表
+
+    def __contains__(self, x):
+        return x in self.parent
+
+    def find(self, x):
+        """所在分组的根"""
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # 路径压缩：沿途节点直接指向根
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def add(self, x):
+        if x not in self.parent:
+            self.parent[x] = x
+            self.rank[x] = 0
+            self.members[x] = [x]
+
+    def union(self, a, b):
+        """合并两个编号所在的分组，返回新的根"""
+        self.add(a)
+        self.add(b)
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return ra
+        if self.rank[ra] < self.rank[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        if self.rank[ra] == self.rank[rb]:
+            self.rank[ra] += 1
+        small, big = sorted((self.members.pop(rb), self.members[ra]), key=len)
+        big.extend(small)
+        self.members[ra] = big
+        return ra
+
+    def discard(self, x):
+        """把编号移出所在分组（编号仍保留在树中作为中间节点）"""
+        if x in self.parent:
+            members = self.members[self.find(x)]
+            if x in members:
+                members.remove(x)
+
+    def group_of(self, x):
+        """编号所在分组的成员"""
+        return list(self.members[self.find(x)]) if x in self.parent else []
+
+    def groups(self, min_size=2):
+        """当前所有成员数不少于 min_size 的分组"""
+        return [list(m) for m in self.members.values() if len(m) >= min_size]
+
+class PathGroups:
+    """按路径使用的相似组：路径映射为整数编号后放进并查集，供界面增量维护分组"""
+
+    def __init__(self, groups=()):
+        self.sets = DisjointSet()
+        self.ids = {}
+        self.paths = []
+        for group in groups:
+            for path in group[1:]:
+                self.union(group[0], path)
+
+    def _id(self, path):
+        if path not in self.ids:
+            self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        return self.ids[path]
+
+    def union(self, a, b):
+        self.sets.union(self._id(a), self._id(b))
+
+    def discard(self, path):
+        if path in self.ids:
+            self.sets.discard(self.ids[path])
+
+    def groups(self):
+        """当前分组（每组路径排序，分组顺序不变）"""
+        return [sorted(self.paths[i] for i in m) for m in self.sets.groups()]
@@ -0,0 +1,168 @@
+"""近邻索引模块"""
+import math
+from itertools import combinations
+import numpy as np
+
+# ===================== 配置 =====================
+LSH_TABLES = 8  # 哈希表数量，越多召回越高
+LSH_BITS = 6  # 每张表的哈希函数个数，越多桶越细、候选越少
+LSH_WIDTH = 0.5  # 量化宽度（相对投影标准差），越大召回越高
+LSH_SEED = 20240229
+PROJECT_BATCH = 1024
+HASH_BITS = 64  # 感知哈希位数
+HAMMING_MAX_MASKS = 100000  # 单段枚举的翻转掩码上限
+HAMMING_TABLE_BITS = 24  # 段长不超过此值时用计数表查桶
+
+def pairs_to_codes(ii, jj, n):
+    """组合 (i, j) 编码为单个整数 i * n + j，便于去重和排序"""
+    return np.asarray(ii, dtype=np.int64) * n + np.asarray(jj, dtype=np.int64)
+
+def codes_to_pairs(codes, n):
+    """整数编码还原为组合 (i, j)"""
+    return codes // n, codes % n
+
+class LSHIndex:
+    """随机投影 LSH（p-stable，按 L2 距离分桶）
+
+    h(x) = floor((a·x + b) / w)，a 为高斯随机向量。每张表由 bits 个哈希函数拼成，
+    任意一张表落入同一桶的两张图片即为候选组合。
+    """
+
+    def __init__(self, dim, tables=LSH_TABLES, bits=LSH_BITS, width=LSH_WIDTH, seed=LSH_SEED):
+        self.dim = dim
+        self.tables = tables
+        self.bits = bits
+        self.width = width
+        rng = np.random.default_rng(seed)
+        self.proj = rng.standard_normal((dim, tables * bits)).astype(np.float32)
+        self.offset = rng.uniform(0, 1, tables * bits)
+        self.keys = None
+
+    def fit(self, feats, batch=PROJECT_BATCH):
+        """计算所有特征的桶编号"""
+        n = len(feats)
+        values = np.zeros((n, self.tables * self.bits))
+        for start in range(0, n, batch):
+            values[start:start + batch] = np.asarray(feats[start:start + batch], dtype=np.float32) @ self.proj
+        # 量化宽度按投影值的离散程度自适应，使参数与特征尺度无关
+        scale = values.std(axis=0) + 1e-12
+        buckets = np.floor(values / (self.width * scale) + self.offset).astype(np.int64)
+        buckets = buckets.reshape(n, self.tables, self.bits)
+        self.keys = np.zeros((n, self.tables), dtype=np.int64)
+        for t in range(self.tables):
+            _, self.keys[:, t] = np.unique(buckets[:, t, :], axis=0, return_inverse=True)
+        return self
+
+    def candidate_codes(self):
+        """所有表中同桶的候选组合，返回排序去重后的整数编码"""
+        n = len(self.keys)
+        codes = []
+        for t in range(self.tables):
+            order = np.argsort(self.keys[:, t], kind='stable')
+            sorted_keys = self.keys[order, t]
+            bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+            for members in np.split(order, bounds):
+                if len(members) < 2:
+                    continue
+                members = np.sort(members)
+                ii, jj = np.triu_indices(len(members), k=1)
+                codes.append(pairs_to_codes(members[ii], members[jj], n))
+        if not codes:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(codes))
+
+def estimate_recall(head, n, threshold, candidate_codes, block, sample=20, seed=LSH_SEED):
+    """抽样若干行与全量比对，估计候选集对真实重复对的召回率
+
+    返回 (命中数, 真实重复数)。
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(n, size=min(sample, n), replace=False)
+    expected = []
+    for i in rows:
+        i = int(i)
+        scores = np.concatenate([head.tile_scores(i, i + 1, j0, min(j0 + block * block, n))[0]
+                                 for j0 in range(0, n, block * block)])
+        scores[i] = -1
+        partners = np.flatnonzero(scores >= threshold)
+        if len(partners) == 0:
+            continue
+        expected.append(pairs_to_codes(np.minimum(i, partners), np.maximum(i, partners), n))
+    if not expected:
+        return 0, 0
+    expected = np.unique(np.concatenate(expected))
+    return int(np.isin(expected, candidate_codes, assume_unique=True).sum()), len(expected)
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def hamming_distance(a, b):
+    """两组64位哈希逐个求汉明距离"""
+    x = np.ascontiguousarray(np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64)))
+    return _POPCOUNT[x.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.int64)
+
+def _flip_masks(bits, radius):
+    """段内汉明距离不超过 radius 的所有翻转掩码"""
+    masks = []
+    for k in range(min(radius, bits) + 1):
+        for idx in combinations(range(bits), k):
+            masks.append(sum(1 << b for b in idx))
+    return np.array(masks, dtype=np.uint64)
+
+def choose_bands(n, radius, bits=HASH_BITS):
+    """按估算代价选择分段数：段数越多每段枚举越少，但每段越短、桶内碰撞越多"""
+    best = None
+    for m in range(1, min(radius + 1, bits) + 1):
+        seg = bits // m
+        masks = sum(math.comb(seg, k) for k in range(min(radius // m, seg) + 1))
+        if masks > HAMMING_MAX_MASKS:
+            continue
+        cost = m * masks * (n + n * n / 2 ** seg)
+        if best is None or cost < best[0]:
+            best = (cost, m)
+    return best[1] if best else radius + 1
+
+def hamming_candidate_codes(hashes, radius, bands=None):
+    """多索引汉明搜索：返回汉明距离不超过 radius 的所有组合（整数编码，排序去重）
+
+    64位哈希切成 m 段，距离不超过 radius 的两个哈希至少有一段的段内距离不超过 radius // m
+    （鸽巢原理），因此每段只需枚举少量翻转掩码做精确匹配，结果不漏。
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    if n < 2:
+        return np.zeros(0, dtype=np.int64)
+    bands = bands or choose_bands(n, radius)
+    edges = np.linspace(0, HASH_BITS, bands + 1).astype(int)
+    
+    codes = []
+    for b in range(bands):
+        lo, hi = int(edges[b]), int(edges[b + 1])
+        keys = (hashes >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        if hi - lo <= HAMMING_TABLE_BITS:
+            # 段较短时用桶计数表直接查找，比二分查找快得多
+            bucket_counts = np.bincount(keys.astype(np.int64), minlength=1 << (hi - lo))
+            bucket_starts = np.cumsum(bucket_counts) - bucket_counts
+        for mask in _flip_masks(hi - lo, radius // bands):
+            target = keys ^ mask
+            if hi - lo <= HAMMING_TABLE_BITS:
+                target = target.astype(np.int64)
+                left = bucket_starts[target]
+                counts = bucket_counts[target]
+            else:
+                left = np.searchsorted(sorted_keys, target, side='left')
+                counts = np.searchsorted(sorted_keys, target, side='right') - left
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            ii = np.repeat(np.arange(n), counts)
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            jj = order[np.repeat(left, counts) + offsets]
+            keep = ii < jj
+            ii, jj = ii[keep], jj[keep]
+            near = hamming_distance(hashes[ii], hashes[jj]) <= radius
+            codes.append(pairs_to_codes(ii[near], jj[near], n))
+    if not codes:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(codes))
@@ -0,0 +1,190 @@
+"""NumPy 推理后端（不依赖 torch）"""
+import os
+import pickle
+import zipfile
+from collections import OrderedDict
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from core_features import FeatureMatrix
+
+try:
+    from threadpoolctl import threadpool_info, threadpool_limits
+except ImportError:
+    threadpool_info = threadpool_limits = None
+
+# ===================== 配置 =====================
+STORAGE_DTYPES = {
+    "FloatStorage": np.float32, "DoubleStorage": np.float64, "HalfStorage": np.float16,
+    "LongStorage": np.int64, "IntStorage": np.int32, "ShortStorage": np.int16,
+    "CharStorage": np.int8, "ByteStorage": np.uint8, "BoolStorage": np.bool_,
+}
+CONV_STRIDE = 2
+CONV_PADDING = 1
+
+# ===================== 权重读取 =====================
+def _rebuild_tensor(storage, offset, size, stride, *args):
+    """按 torch 的 (偏移, 形状, 步长) 从存储中切出数组"""
+    itemsize = storage.dtype.itemsize
+    return as_strided(storage[offset:], shape=tuple(size),
+                      strides=tuple(s * itemsize for s in stride)).copy()
+
+class _PthUnpickler(pickle.Unpickler):
+    """只认识 state_dict 用到的少数几个类，其他内容一律拒绝"""
+
+    def __init__(self, f, archive, prefix):
+        super().__init__(f)
+        self.archive = archive
+        self.prefix = prefix
+
+    def find_class(self, module, name):
+        if module == "collections" and name == "OrderedDict":
+            return OrderedDict
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return _rebuild_tensor
+        if module == "torch" and name in STORAGE_DTYPES:
+            return name
+        raise pickle.UnpicklingError(f"不支持的模型内容: {module}.{name}")
+
+    def persistent_load(self, pid):
+        _, storage_type, key, _location, _numel = pid
+        data = self.archive.read(f"{self.prefix}/data/{key}")
+        return np.frombuffer(data, dtype=STORAGE_DTYPES[storage_type])
+
+def read_pth(path):
+    """不借助 torch 读取 torch.save 保存的 state_dict（zip 格式）"""
+    with zipfile.ZipFile(path) as archive:
+        pkl = next(name for name in archive.namelist() if name.endswith("/data.pkl"))
+        prefix = pkl[:-len("/data.pkl")]
+        with archive.open(pkl) as f:
+            return OrderedDict(_PthUnpickler(f, archive, prefix).load())
+
+def npz_path_for(model_path):
+    """模型文件对应的 .npz 权重路径"""
+    return os.path.splitext(str(model_path))[0] + ".npz"
+
+def convert_to_npz(model_path, npz_path=None):
+    """把 .pth 权重转换为 .npz，之后加载无需解析 pickle"""
+    npz_path = npz_path or npz_path_for(model_path)
+    np.savez(npz_path, **read_pth(model_path))
+    return npz_path
+
+def load_weights(model_path):
+    """读取权重：优先使用同名且不早于 .pth 的 .npz"""
+    model_path = str(model_path)
+    if model_path.endswith(".npz"):
+        npz_path = model_path
+    else:
+        npz_path = npz_path_for(model_path)
+        if not (os.path.exists(npz_path) and os.path.getmtime(npz_path) >= os.path.getmtime(model_path)):
+            return read_pth(model_path)
+    with np.load(npz_path) as data:
+        return {k: data[k] for k in data.files}
+
+# ===================== 模型 =====================
+def conv2d(x, weight, bias, stride=CONV_STRIDE, padding=CONV_PADDING):
+    """im2col 卷积：x 为 NHWC，weight 为 torch 的 (out, in, kh, kw)，返回 NHWC"""
+    n, h, w, c = x.shape
+    out_c, _, kh, kw = weight.shape
+    x = np.pad(x, ((0, 0), (padding, padding), (padding, padding), (0, 0)))
+    oh = (h + 2 * padding - kh) // stride + 1
+    ow = (w + 2 * padding - kw) // stride + 1
+    sn, sh, sw, sc = x.strides
+    cols = as_strided(x, shape=(n, oh, ow, kh, kw, c), strides=(sn, sh * stride, sw * stride, sh, sw, sc))
+    cols = cols.reshape(n * oh * ow, kh * kw * c)
+    kernel = weight.transpose(0, 2, 3, 1).reshape(out_c, -1)
+    out = cols @ kernel.T
+    out += bias
+    return out.reshape(n, oh, ow, out_c)
+
+class NumpyTinyModel:
+    """TinyModel 的 NumPy 实现，权重与 torch 版本共用"""
+
+    def __init__(self, state):
+        state = {k: np.ascontiguousarray(v, dtype=np.float32) for k, v in state.items()}
+        self.conv1 = (state["feat.0.weight"], state["feat.0.bias"])
+        self.conv2 = (state["feat.2.weight"], state["feat.2.bias"])
+        self.W1 = state["sim.0.weight"]
+        self.b1 = state["sim.0.bias"]
+        self.w2 = state["sim.2.weight"][0]
+        self.b2 = float(state["sim.2.bias"][0])
+
+    def feat(self, x):
+        """(N, 3, H, W) → (N, dim)，展平顺序与 torch 的 NCHW 一致"""
+        x = np.ascontiguousarray(np.asarray(x, dtype=np.float32).transpose(0, 2, 3, 1))
+        x = np.maximum(conv2d(x, *self.conv1), 0)
+        x = np.maximum(conv2d(x, *self.conv2), 0)
+        return np.ascontiguousarray(x.transpose(0, 3, 1, 2)).reshape(len(x), -1)
+
+    def sim(self, diff):
+        """sim 头：|f1 - f2| (N, dim) → 相似度 (N,)"""
+        hidden = diff @ self.W1.T
+        hidden += self.b1
+        np.maximum(hidden, 0, out=hidden)
+        logits = hidden @ self.w2 + self.b2
+        return 1 / (1 + np.exp(-logits))
+
+def load_model(model_path, device="cpu"):
+    """加载模型（只支持 CPU）"""
+    return NumpyTinyModel(load_weights(model_path))
+
+def pick_device(use_gpu=False):
+    """NumPy 后端只在 CPU 上运行"""
+    return "cpu"
+
+def get_threads():
+    """当前的 BLAS 线程数（需要 threadpoolctl，未安装时返回 None）"""
+    if threadpool_info is None:
+        return None
+    return max((lib["num_threads"] for lib in threadpool_info() if lib.get("user_api") == "blas"), default=None)
+
+def set_threads(threads):
+    """设置 BLAS 线程数（需要 threadpoolctl，未安装时由 OMP_NUM_THREADS 等环境变量决定）"""
+    if threadpool_limits is not None:
+        threadpool_limits(threads)
+
+def extract_batch(model, x, device="cpu"):
+    """批量提取特征：输入 (N, 3, H, W) float32 数组，返回 (N, dim) float32 数组"""
+    return model.feat(x)
+
+# ===================== 批量 sim 头 =====================
+class NumpySimHead:
+    """在缓存特征上批量计算 sim 头（接口与 TorchSimHead 相同）"""
+
+    def __init__(self, model, device="cpu"):
+        self.model = model
+        self.features = None
+
+    def bind(self, feats):
+        """绑定特征矩阵 (n, dim)，压缩编码的矩阵保持原样，计算时逐块解码"""
+        self.features = feats if isinstance(feats, FeatureMatrix) else np.asarray(feats)
+
+    def weights(self):
+        """sim 头参数 (W1, b1, w2, b2)"""
+        return self.model.W1, self.model.b1, self.model.w2, self.model.b2
+
+    def rows(self, index):
+        """取出若干行并解码为 float32"""
+        return np.asarray(self.features[index], dtype=np.float32)
+
+    def tile_scores(self, i0, i1, j0, j1):
+        """计算 F[i0:i1] × F[j0:j1] 整块的相似度矩阵"""
+        fi = self.rows(slice(i0, i1))
+        fj = self.rows(slice(j0, j1))
+        diff = np.abs(fi[:, None, :] - fj[None, :, :]).reshape(-1, fi.shape[1])
+        return self.model.sim(diff).reshape(i1 - i0, j1 - j0)
+
+    def pair_scores(self, ii, jj):
+        """计算指定组合 (ii[k], jj[k]) 的相似度"""
+        return self.model.sim(np.abs(self.rows(ii) - self.rows(jj)))
+
+    def tile_gram(self, i0, i1, j0, j1):
+        """计算 F[i0:i1] · F[j0:j1]^T"""
+        return self.rows(slice(i0, i1)) @ self.rows(slice(j0, j1)).T
+
+SimHead = NumpySimHead
+
+if __name__ == "__main__":
+    # 用法: python core_numpy.py tiny_similarity-A.pth [tiny_similarity-B.pth ...]
+    import sys
+    for path in sys.argv[1:]:
+        print(f"{path} -> {convert_to_npz(path)}")
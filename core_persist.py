@@ -0,0 +1,104 @@
+"""后台持久化模块"""
+import os
+import json
+import time
+import atexit
+import threading
+
+# ===================== 配置 =====================
+PERSIST_INTERVAL = 2.0  # 改动最多积攒的秒数
+PERSIST_MAX_ROWS = 5000  # 积攒的改动条数超过此值时立即写入
+PERSIST_EXIT_TIMEOUT = 30  # 退出时等待写完的最长秒数
+
+def atomic_write_json(path, data, **kwargs):
+    """先写临时文件再替换，中途崩溃不会留下写了一半的文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp_path, path)
+
+class PersistService:
+    """后台持久化线程：合并各处提交的改动，攒够时间或数量后在后台写入
+
+    write(改动) 执行实际写入，merge(旧, 新) 合并两批改动，size(改动) 返回改动条数。
+    flush() 等待已提交的改动全部写完，退出前自动调用。写入失败的改动保留，下一轮重试，
+    此时 flush() 不再等待，直接返回 False。
+    """
+
+    def __init__(self, write, merge, size, interval=PERSIST_INTERVAL, max_rows=PERSIST_MAX_ROWS):
+        self.write = write
+        self.merge = merge
+        self.size = size
+        self.interval = interval
+        self.max_rows = max_rows
+        self.cond = threading.Condition()
+        self.pending = None
+        self.since = None
+        self.busy = False
+        self.failed = False
+        self.flushing = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush, PERSIST_EXIT_TIMEOUT)
+
+    def submit(self, changes):
+        """提交一批改动（立即返回）"""
+        with self.cond:
+            self.pending = changes if self.pending is None else self.merge(self.pending, changes)
+            if self.since is None:
+                self.since = time.monotonic()
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """写入屏障：等待已提交的改动全部写完，超时或写入失败返回 False"""
+        with self.cond:
+            if self.closed:
+                return True
+            self.flushing += 1
+            self.cond.notify_all()
+            try:
+                self.cond.wait_for(lambda: (self.pending is None or self.failed) and not self.busy, timeout)
+                return self.pending is None and not self.busy
+            finally:
+                self.flushing -= 1
+
+    def close(self, timeout=None):
+        """写完剩余改动后停止后台线程"""
+        self.flush(timeout)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        atexit.unregister(self.flush)
+
+    def _ready(self):
+        if self.closed or time.monotonic() - self.since >= self.interval:
+            return True
+        # 上次写入失败时只按时间重试
+        return not self.failed and (self.flushing or self.size(self.pending) >= self.max_rows)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed and (self.pending is None or not self._ready()):
+                    self.cond.wait(None if self.pending is None else max(0, self.since + self.interval - time.monotonic()))
+                if self.pending is None:
+                    return
+                changes, self.pending, self.since = self.pending, None, None
+                self.busy = True
+            try:
+                self.write(changes)
+                self.failed = False
+            except Exception as e:
+                print(f"后台保存失败，稍后重试: {str(e)}")
+                with self.cond:
+                    self.failed = True
+                    self.pending = changes if self.pending is None else self.merge(changes, self.pending)
+                    self.since = time.monotonic()
+                    if self.closed:
+                        self.pending = None
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
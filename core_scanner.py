@@ -1,17 +1,35 @@
 """扫描模块"""
 import os
 import json
+import time
+import hashlib
 import cv2
 import numpy as np
-from pathlib import Path
 import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from queue import Queue
+from core_features import InputStore, image_fingerprint, model_input
+from core_thumbs import encode_thumb, migrate_legacy_thumbs, thumb_store
+from core_db import workspace_db, workspace_persist
+from core_persist import atomic_write_json
 
 # ===================== 配置 =====================
 TEMP_FOLDER = "_image_temp"
-DB_PATH = os.path.join(TEMP_FOLDER, "db.json")
+DB_PATH = os.path.join(TEMP_FOLDER, "db.sqlite")
 IMG_MAX_SIZE = 400
-THREAD_NUM = 8
+THREAD_NUM = 8  # 进程池无法启动时改用的线程数
+SCAN_PROCESS_NUM = max(1, multiprocessing.cpu_count())  # 解码/缩放/编码进程数
+SCAN_QUEUE_SIZE = 64  # 发现 → 读取队列长度
+SCAN_INFLIGHT = max(8, SCAN_PROCESS_NUM * 4)  # 已读取但尚未写入的图片上限（内存上限）
+WALK_THREADS = 16  # 并发遍历的目录数（网络盘上主要是等待延迟）
+DIR_CACHE_PATH = os.path.join(TEMP_FOLDER, "dir_cache.json")
+DIR_MTIME_SAFETY_NS = 2 * 10 ** 9  # 修改时间距今不足此值的目录不缓存（FAT 等文件系统精度为 2 秒）
+HASH_CHUNK = 64 * 1024  # 首尾块哈希的块大小
+DHASH_SIZE = 8  # 感知哈希边长（8x8 = 64位）
+# JPEG 在 DCT 域按 1/8、1/4、1/2 缩小解码，取缩小后仍不小于缩略图尺寸的最大倍数
+JPEG_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
 
 # 支持的图片格式
 DEFAULT_ALLOW_EXTS = {".png", ".jpg", ".jpeg", ".bmp", ".webp", ".tiff", ".tif", ".gif"}
@@ -42,37 +60,50 @@ def get_allowed_extensions():
 
 ALLOW_EXTS = get_allowed_extensions()
 
-def cv2_imread(file_path):
-    try:
-        stream = open(file_path, 'rb')
-        bytes = bytearray(stream.read())
-        numpyarray = np.asarray(bytes, dtype=np.uint8)
-        return cv2.imdecode(numpyarray, cv2.IMREAD_UNCHANGED)
-    except:
-        return None
+def jpeg_size(data):
+    """从 JPEG 的 SOF 段读取原图 (宽, 高)，解析失败返回 None"""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[i + 7] << 8) | data[i + 8], (data[i + 5] << 8) | data[i + 6]
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
 
-def cv2_imwrite(file_path, img):
-    try:
-        ext = '.png'
-        success, enc = cv2.imencode(ext, img)
-        if success:
-            with open(file_path, 'wb') as f:
-                enc.tofile(f)
-        return success
-    except:
-        return False
-
-def copy_and_process_image(src, dst):
-    """复制并处理图片到临时文件夹"""
-    img = cv2_imread(src)
+def decode_for_thumb(data, target=IMG_MAX_SIZE):
+    """按格式选择解码方式，返回 (图片, 原图宽, 原图高)，失败时图片为 None
+
+    JPEG 按原图尺寸选最大的 DCT 域缩小倍数，解码后仍不小于 target，省去大部分解码时间和内存；
+    其他格式完整解码。与完整解码一样忽略 EXIF 方向。
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if data[:2] == b'\xff\xd8':
+        size = jpeg_size(data)
+        if size:
+            for factor, flag in JPEG_REDUCED_FLAGS:
+                if max(size) // factor >= target:
+                    img = cv2.imdecode(buf, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+                    if img is not None:
+                        return img, size[0], size[1]
+                    break
+    img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
     if img is None:
-        return False
-    
+        return None, 0, 0
+    return img, img.shape[1], img.shape[0]
+
+def make_thumbnail(img, w, h):
+    """缩放为缩略图，尺寸按原图尺寸 (w, h) 计算，缩小解码不改变缩略图大小"""
     if len(img.shape) == 2:
         img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
     
-    h, w = img.shape[:2]
-    
     if max(h, w) <= 400:
         if h >= w:
             scale = 400.0 / h
@@ -95,48 +126,268 @@ def copy_and_process_image(src, dst):
             new_h = int(new_h * scale)
     
     # 调整图片大小
-    img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-    
-    return cv2_imwrite(dst, img)
+    return cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+def init_scan_worker():
+    """扫描进程初始化：并行由进程池负责，OpenCV 内部只用单线程"""
+    cv2.setNumThreads(1)
+
+def process_thumb_task(data, fmt="png", quality=90):
+    """解码、缩放并编码缩略图（在进程池中运行）
 
-def resize_and_save(src, dst):
-    """调整图片大小并保存为缩略图"""
-    return copy_and_process_image(src, dst)
+    成功时返回 (缩略图数据, 格式, 感知哈希, 模型输入或 None, 耗时)，失败返回 None。
+    趁图片还在内存中顺便计算感知哈希和模型输入（PNG 无损，与解码缩略图得到的完全一致）。
+    """
+    start = time.perf_counter()
+    img, w, h = decode_for_thumb(data)
+    if img is None:
+        return None
+    img = make_thumbnail(img, w, h)
+    thumb, fmt = encode_thumb(img, fmt, quality)
+    pixels = model_input(img) if img.dtype == np.uint8 else None
+    return thumb, fmt, image_dhash(img), pixels, time.perf_counter() - start
+
+def image_dhash(img):
+    """64位差值哈希（dHash），返回16位十六进制字符串"""
+    if img.ndim == 3:
+        if img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+        else:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, (DHASH_SIZE + 1, DHASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return f"{int(np.packbits(bits).view('>u8')[0]):016x}"
+
+def partial_hash(file_path, size):
+    """文件首尾块哈希"""
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        h.update(f.read(HASH_CHUNK))
+        if size > HASH_CHUNK:
+            f.seek(max(HASH_CHUNK, size - HASH_CHUNK))
+            h.update(f.read(HASH_CHUNK))
+    return h.hexdigest()
+
+def full_hash(file_path, chunk_size=1024 * 1024):
+    """文件全文哈希"""
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def find_exact_duplicates(paths, known_hashes=None, known_partials=None):
+    """分级哈希查找字节完全相同的文件：先按大小分桶，再比首尾块，最后只对碰撞的文件算全文哈希
+
+    paths: 路径列表，或扫描得到的 {路径: [大小, 修改时间 ns, inode]}（免去重复 stat）。
+    known_hashes / known_partials: {path: (size, mtime_ns, sha1 或首尾块哈希)}，大小和修改时间未变时直接复用。
+    返回 (分组列表, {path: (size, mtime_ns, sha1)}, {path: (size, mtime_ns, 首尾块哈希)})。
+    """
+    known_hashes = known_hashes or {}
+    known_partials = known_partials or {}
+    stats = paths if isinstance(paths, dict) else {p: file_stat(p) for p in paths}
+    by_size = {}
+    for p, fp in stats.items():
+        if fp:
+            by_size.setdefault(fp[0], []).append(p)
+    
+    groups = []
+    hashes = {}
+    partials = {}
+    for size, same_size in by_size.items():
+        if len(same_size) < 2 or size == 0:
+            continue
+        by_partial = {}
+        for p in same_size:
+            cached = known_partials.get(p)
+            if cached and tuple(cached[:2]) == (size, stats[p][1]):
+                partial = cached[2]
+            else:
+                try:
+                    partial = partial_hash(p, size)
+                except OSError:
+                    continue
+            partials[p] = (size, stats[p][1], partial)
+            by_partial.setdefault(partial, []).append(p)
+        for partial, candidates in by_partial.items():
+            if len(candidates) < 2:
+                continue
+            by_full = {}
+            for p in candidates:
+                key = (size, stats[p][1])
+                cached = known_hashes.get(p)
+                if size <= 2 * HASH_CHUNK:
+                    # 首尾块已覆盖全文，首尾块哈希即全文哈希
+                    digest = partial
+                elif cached and tuple(cached[:2]) == key:
+                    digest = cached[2]
+                else:
+                    try:
+                        digest = full_hash(p)
+                    except OSError:
+                        continue
+                hashes[p] = (size, stats[p][1], digest)
+                by_full.setdefault(digest, []).append(p)
+            groups.extend(sorted(g) for g in by_full.values() if len(g) > 1)
+    return groups, hashes, partials
 
 def load_db():
-    """加载数据库"""
-    os.makedirs(TEMP_FOLDER, exist_ok=True)
-    if not os.path.exists(DB_PATH):
-        db = {
-            "state": "idle", "index": 0, "files": {}, "duplicates": [],
-            "scan_processed": 0, "last_file_list": [], "last_file_count": 0
-        }
+    """加载数据库（首次运行时自动导入旧版 db.json）"""
+    db = workspace_db(DB_PATH).load()
+    # 旧版每张图片一个 PNG，导入打包缩略图库
+    files = db["files"]
+    if migrate_legacy_thumbs(files):
+        for p in files:
+            files.touch(p)
         save_db(db)
-        return db
-    with open(DB_PATH, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return db
+
+def save_db(db, keys=None):
+    """保存数据库：只提交改动过的图片记录和 keys 中（None 表示全部）的字段，由后台线程合并写入"""
+    workspace_persist(DB_PATH).submit(workspace_db(DB_PATH).collect(db, keys))
+
+def flush_db(timeout=None):
+    """等待已提交的保存全部写入磁盘，返回是否写完"""
+    return workspace_persist(DB_PATH).flush(timeout)
+
+class StageStats:
+    """流水线各阶段的吞吐统计（线程安全）"""
+
+    def __init__(self, stages):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stages = {name: [0, 0, 0.0] for name in stages}  # 数量, 字节数, 忙碌秒数
+
+    def add(self, stage, count=1, nbytes=0, busy=0.0):
+        with self.lock:
+            entry = self.stages[stage]
+            entry[0] += count
+            entry[1] += nbytes
+            entry[2] += busy
+
+    def summary(self):
+        """每个阶段一行：数量、吞吐和忙碌时间"""
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        lines = []
+        with self.lock:
+            for name, (count, nbytes, busy) in self.stages.items():
+                line = f"{name}: {count} 张，{count / elapsed:.1f} 张/秒"
+                if nbytes:
+                    line += f"，{nbytes / elapsed / 2 ** 20:.1f} MB/秒"
+                if busy:
+                    line += f"，累计耗时 {busy:.1f} 秒"
+                lines.append(line)
+        return lines
+
+def file_stat(path):
+    """文件指纹 [大小, 修改时间 ns, inode]，文件不存在返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def stat_files(path, names, links):
+    """目录中图片的 (路径, 指纹) 列表，符号链接按原来的方式解析为目标路径"""
+    files = []
+    for name in names:
+        full = os.path.join(path, name)
+        fp = file_stat(full)
+        if fp:
+            files.append((full, fp))
+    for name in links:
+        full = os.path.realpath(os.path.join(path, name))
+        fp = file_stat(full)
+        if fp:
+            files.append((full, fp))
+    return files
 
-def save_db(db):
-    """保存数据库"""
-    with open(DB_PATH, 'w', encoding='utf-8') as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+def scan_directory(path, cached, exts, now_ns):
+    """列出一个目录中的图片和子目录，目录修改时间与缓存一致时直接沿用缓存的列表
 
-def scan_images():
-    """扫描所有图片文件"""
+    返回 (缓存条目或 None, [(图片路径, 指纹)], 子目录名, 是否沿用缓存)。
+    原地修改文件不会改变目录的修改时间，所以每张图片仍要取一次指纹。
+    修改时间离现在太近的目录不写入缓存，避免同一时间粒度内的后续改动被漏掉。
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None, [], [], False
+    if cached and cached[0] == mtime:
+        return cached, stat_files(path, cached[1], cached[2]), cached[3], True
+    
+    names, links, dirs = [], [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != TEMP_FOLDER:
+                            dirs.append(entry.name)
+                    elif os.path.splitext(entry.name)[1].lower() in exts:
+                        (links if entry.is_symlink() else names).append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return None, [], [], False
+    entry = [mtime, names, links, dirs] if now_ns - mtime > DIR_MTIME_SAFETY_NS else None
+    return entry, stat_files(path, names, links), dirs, False
+
+def walk_images(root, exts, cache=None, threads=WALK_THREADS):
+    """多线程遍历目录树，返回 ([(图片路径, 指纹)], 新的目录缓存, 统计)"""
+    cache = cache or {}
+    now_ns = time.time_ns()
+    new_cache = {}
     res = []
-    temp_abs = Path(TEMP_FOLDER).resolve()
-    for p in Path('.').rglob('*'):
-        try:
-            if temp_abs in p.resolve().parents:
-                continue
-        except:
-            continue
-        if p.suffix.lower() in ALLOW_EXTS:
-            try:
-                res.append(str(p.resolve()).replace('\\', '/').strip())
-            except:
-                continue
-    return sorted(list(set(res)))
+    stats = {"dirs": 0, "cached": 0}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(scan_directory, root, cache.get(root), exts, now_ns): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                entry, files, dirs, reused = future.result()
+                stats["dirs"] += 1
+                stats["cached"] += reused
+                if entry:
+                    new_cache[path] = entry
+                res.extend(files)
+                for name in dirs:
+                    sub = os.path.join(path, name)
+                    pending[executor.submit(scan_directory, sub, cache.get(sub), exts, now_ns)] = sub
+    return res, new_cache, stats
+
+def load_dir_cache():
+    """加载目录缓存，允许的扩展名改变时失效"""
+    try:
+        if os.path.exists(DIR_CACHE_PATH):
+            with open(DIR_CACHE_PATH, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if sorted(data.get("exts", [])) == sorted(ALLOW_EXTS):
+                return data.get("dirs", {})
+    except Exception as e:
+        print(f"读取目录缓存失败，重新遍历: {str(e)}")
+    return {}
+
+def save_dir_cache(dirs):
+    """保存目录缓存"""
+    try:
+        os.makedirs(TEMP_FOLDER, exist_ok=True)
+        atomic_write_json(DIR_CACHE_PATH, {"exts": sorted(ALLOW_EXTS), "dirs": dirs}, ensure_ascii=False)
+    except Exception as e:
+        print(f"保存目录缓存失败: {str(e)}")
+
+def scan_images(stats=None):
+    """扫描所有图片文件（跳过 _image_temp，未变化的目录直接沿用缓存），返回按路径排序的 {路径: 指纹}"""
+    root = os.path.realpath('.')
+    res, dirs, walk_stats = walk_images(root, ALLOW_EXTS, load_dir_cache())
+    save_dir_cache(dirs)
+    if stats is not None:
+        stats.update(walk_stats)
+    return dict(sorted((p.replace('\\', '/').strip(), fp) for p, fp in res))
 
 class Scanner:
     """扫描器类"""
@@ -147,6 +398,10 @@ class Scanner:
         self.log_callback = log_callback
         self.scanning = False
         self.stop_requested = False
+        self.inputs = None
+        self._stats = {}
+        self._hashes = {}
+        self._partials = {}
         
     def log(self, message):
         """记录日志"""
@@ -158,51 +413,129 @@ class Scanner:
         if self.progress_callback:
             self.progress_callback(current, total, message)
     
-    def worker(self, q, lock, total):
-        """工作线程"""
-        while not self.stop_requested:
-            try:
-                item = q.get(timeout=1)
+    def _make_pool(self):
+        """解码/缩放/编码阶段的进程池，进程池无法启动时改用线程池"""
+        try:
+            pool = multiprocessing.Pool(SCAN_PROCESS_NUM, initializer=init_scan_worker)
+            return pool, f"{SCAN_PROCESS_NUM} 进程"
+        except Exception as e:
+            self.log(f"无法启动扫描进程池，改用线程: {str(e)}")
+            return ThreadPool(THREAD_NUM), f"{THREAD_NUM} 线程"
+    
+    def run_pipeline(self, todo, total):
+        """扫描流水线：发现 → 读取 → 解码/缩放/编码（进程池）→ 写入
+
+        各阶段之间用有界队列连接，已读取但尚未写入的图片最多 SCAN_INFLIGHT 张，内存占用与图库大小无关。
+        只有写入阶段（调用线程）修改数据库，结果按提交顺序写入。
+        """
+        stats = StageStats(["发现", "读取", "处理", "写入"])
+        path_q = Queue(maxsize=SCAN_QUEUE_SIZE)
+        done_q = Queue()
+        inflight = threading.BoundedSemaphore(SCAN_INFLIGHT)
+        store = thumb_store()
+        pool, pool_desc = self._make_pool()
+        self.log(f"扫描流水线: 解码/缩放/编码 {pool_desc}，最多 {SCAN_INFLIGHT} 张在途")
+        
+        def discover():
+            """发现阶段：按顺序送出待处理的文件"""
+            for seq, path in enumerate(todo):
+                if self.stop_requested:
+                    break
+                path_q.put((seq, path))
+                stats.add("发现")
+            path_q.put(None)
+        
+        def read():
+            """读取阶段：读入文件内容并提交到进程池，在途图片达到上限时阻塞"""
+            submitted = 0
+            while True:
+                item = path_q.get()
                 if item is None:
                     break
-                    
-                path, idx = item
+                if self.stop_requested:
+                    continue  # 停止后只清空队列，已提交的序号仍然连续
+                seq, path = item
+                inflight.acquire()
+                submitted += 1
+                start = time.perf_counter()
                 try:
-                    with lock:
-                        file_count = len(self.db["files"])
-                        tid = f"img_{file_count}"
-                        thumb = os.path.join(TEMP_FOLDER, f"{tid}.png").replace('\\', '/')
-                        
-                        self.db["files"][path] = {"id": tid, "thumb": thumb}
-                        self.db["scan_processed"] += 1
-                    
-                    # 处理图片
-                    success = resize_and_save(path, thumb)
-                    
-                    if not success:
-                        # 数据库中移除
-                        with lock:
-                            if path in self.db["files"]:
-                                del self.db["files"][path]
-                                self.db["scan_processed"] -= 1
-                    
-                    # 保存数据库
-                    if self.db["scan_processed"] % 10 == 0:
-                        with lock:
-                            save_db(self.db)
-                    
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except OSError as e:
+                    done_q.put((seq, path, e))
+                    continue
+                stats.add("读取", 1, len(data), time.perf_counter() - start)
+                pool.apply_async(process_thumb_task, (data, store.fmt, store.quality),
+                                 callback=lambda r, seq=seq, path=path: done_q.put((seq, path, r)),
+                                 error_callback=lambda e, seq=seq, path=path: done_q.put((seq, path, e)))
+            done_q.put((None, submitted, None))
+        
+        stages = [threading.Thread(target=discover, daemon=True), threading.Thread(target=read, daemon=True)]
+        for t in stages:
+            t.start()
+        
+        # 写入阶段：按提交顺序写入数据库、缩略图库和模型输入缓存
+        pending = {}
+        next_seq = 0
+        expected = None
+        finished = False
+        try:
+            while expected is None or next_seq < expected:
+                seq, path, result = done_q.get()
+                if seq is None:
+                    expected = path
+                    continue
+                pending[seq] = (path, result)
+                while next_seq in pending:
+                    self._write_result(store, *pending.pop(next_seq), stats)
+                    next_seq += 1
+                    inflight.release()
                     processed = self.db["scan_processed"]
                     self.update_progress(processed, total, f"处理: {processed}/{total}")
-                    
-                except Exception as e:
-                    self.log(f"处理文件 {path} 时出错: {str(e)}")
-                finally:
-                    q.task_done()
-                    
-            except:
-                if self.stop_requested:
-                    break
-                continue
+            finished = True
+        finally:
+            if self.stop_requested or not finished:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+            for t in stages:
+                t.join(timeout=1)
+            save_db(self.db)
+            self.inputs.save()
+            store.save()
+        
+        for line in stats.summary():
+            self.log(f"扫描统计 {line}")
+    
+    def _write_result(self, store, path, result, stats):
+        """写入一张图片的处理结果（只在写入阶段调用）"""
+        if isinstance(result, Exception) or not result:
+            if result:
+                self.log(f"处理文件 {path} 时出错: {str(result)}")
+            return
+        start = time.perf_counter()
+        thumb, fmt, dhash, pixels, busy = result
+        stats.add("处理", 1, 0, busy)
+        
+        # 已有记录的文件沿用原编号，新文件取计数器的下一个编号
+        info = self.db["files"].get(path)
+        if info and not info.get("copy_of"):
+            tid = info["id"]
+        else:
+            tid = self._next_file_id()
+            self.db["scan_processed"] += 1
+        store.put_bytes(tid, thumb, fmt)
+        self.db["files"][path] = {"id": tid, "thumb": tid, "dhash": dhash, "stat": self._stats.get(path)}
+        if pixels is not None:
+            self.inputs.append(image_fingerprint(path, {"thumb": tid}), pixels)
+        
+        # 保存数据库
+        if self.db["scan_processed"] % 10 == 0:
+            save_db(self.db, ("scan_processed", "next_id"))
+            self.inputs.save()
+            store.save()
+        stats.add("写入", 1, 0, time.perf_counter() - start)
     
     def start_scan(self):
         """开始扫描"""
@@ -213,92 +546,74 @@ class Scanner:
         self.stop_requested = False
         
         try:
-            all_files = scan_images()
-            total = len(all_files)
-            self.log(f"扫描到 {total} 张图片")
-            
-            cur_files = sorted(all_files)
-            cur_cnt = len(cur_files)
-            last_cnt = self.db.get("last_file_count", 0)
-            last_files = self.db.get("last_file_list", [])
-            scan_processed = self.db.get("scan_processed", 0)
+            walk_stats = {}
+            current = scan_images(walk_stats)
+            total = len(current)
+            self.log(f"扫描到 {total} 张图片（{walk_stats['dirs']} 个目录，其中 {walk_stats['cached']} 个未变化）")
             
-            finished = (scan_processed == last_cnt) and last_cnt > 0
-            
-            if last_cnt == 0 or cur_cnt != last_cnt:
-                self.log(f"首次扫描或文件数量变化: 上次 {last_cnt} 个文件，本次 {cur_cnt} 个文件")
-                
-                # 新增文件
-                new_files = [f for f in cur_files if f not in last_files]
-                
-                # 删除文件
-                deleted_files = [f for f in last_files if f not in cur_files]
-                
-                if deleted_files:
-                    self.log(f"发现 {len(deleted_files)} 个被删除的文件")
-                    # 从数据库中移除被删除的文件
-                    for f in deleted_files:
-                        if f in self.db["files"]:
-                            del self.db["files"][f]
-                    
-                    # 重新序列化ID
-                    self._resequence_file_ids()
-                
-                if new_files:
-                    self.log(f"发现 {len(new_files)} 个新增文件")
-                    todo = new_files
-                    prog = scan_processed
-                else:
-                    self.log("发现有文件被删除")
-                    self.db["last_file_list"] = cur_files
-                    self.db["last_file_count"] = cur_cnt
-                    save_db(self.db)
-                    return True
-            else:
-                if finished:
-                    if cur_files == last_files:
-                        self.log("文件无变化")
-                        return True
+            # 按 (大小, 修改时间, inode) 指纹精确比对出新增、删除和修改的文件
+            files = self.db["files"]
+            removed = [p for p in files if p not in current]
+            added = [p for p in current if p not in files]
+            modified = []
+            for p, info in files.items():
+                if p in current and info.get("stat") != current[p]:
+                    if "stat" in info:
+                        modified.append(p)
                     else:
-                        self.log("文件列表发生改动，重新扫描")
-                        self.db["files"] = {}
-                        self.db["scan_processed"] = 0
-                        self.db["last_file_count"] = cur_cnt
-                        self.db["last_file_list"] = cur_files
-                        save_db(self.db)
-                        prog = 0
-                        todo = cur_files
-                else:
-                    prog = scan_processed
-                    todo = cur_files[prog:]
-                    self.log(f"续扫 {prog}/{cur_cnt}")
+                        # 旧版数据库没有指纹，视为未改动，直接记录当前指纹
+                        info["stat"] = current[p]
+                        files.touch(p)
             
-            if not todo:
-                self.log("没有需要处理的文件")
-                return True
+            if removed:
+                self.log(f"发现 {len(removed)} 个被删除的文件")
+                for p in removed:
+                    del files[p]
+            if added:
+                self.log(f"发现 {len(added)} 个新增文件")
+            if modified:
+                self.log(f"发现 {len(modified)} 个被修改的文件，重新生成缩略图")
+            if not (removed or added or modified):
+                self.log("文件无变化")
+            self.db["scan_processed"] = len(files)
+            self._stats = current
+            todo = added + modified
             
-            q = Queue()
-            lock = threading.Lock()
+            # 字节完全相同的文件只处理一份，其余直接指向代表文件
+            copy_of = self._find_exact_copies(current)
+            todo = list(dict.fromkeys([p for p in todo if p not in copy_of] + self._unlink_stale_copies(copy_of)))
             
-            for i, p in enumerate(todo):
-                q.put((p, prog + i))
+            if todo:
+                self.inputs = InputStore()
+                self.run_pipeline(todo, total)
+            else:
+                self.log("没有需要处理的文件")
             
-            workers = []
-            for _ in range(min(THREAD_NUM, len(todo))):
-                t = threading.Thread(target=self.worker, args=(q, lock, total), daemon=True)
-                t.start()
-                workers.append(t)
+            if self.stop_requested:
+                # 已处理的图片已写入，副本关联和缩略图库压缩留到下次扫描
+                save_db(self.db)
+                self.log("扫描已停止，进度已保存")
+                return False
             
-            q.join()
+            self._link_exact_copies(copy_of)
             
-            for _ in range(len(workers)):
-                q.put(None)
+            # 删除或变为副本的文件留下的缩略图成为废弃数据，比例过高时压缩
+            store = thumb_store()
+            store.retain(info["thumb"] for info in self.db["files"].values())
+            store.save()
+            if store.compact():
+                self.log("缩略图库已压缩")
             
-            for t in workers:
-                t.join(timeout=1)
+            # 删除或改动的图片留下的模型输入同样按比例压缩
+            inputs = InputStore()
+            inputs.retain(image_fingerprint(p, info) for p, info in self.db["files"].items())
+            inputs.save()
+            if inputs.compact():
+                self.log("模型输入缓存已压缩")
             
-            self.db["last_file_list"] = cur_files
-            self.db["last_file_count"] = cur_cnt
+            self.db["scan_processed"] = len(self.db["files"])
+            for key in ("last_file_list", "last_file_count"):
+                self.db.pop(key, None)
             save_db(self.db)
             
             self.log("扫描完成")
@@ -310,30 +625,74 @@ class Scanner:
         finally:
             self.scanning = False
     
-    def _resequence_file_ids(self):
-        """重新序列化文件ID"""
+    def _find_exact_copies(self, cur_files):
+        """查找字节完全相同的文件，返回 {副本路径: 代表文件路径}"""
         files = self.db["files"]
-        sorted_files = sorted(files.items(), key=lambda x: x[0])  
+        known = {p: info["sha1"] for p, info in files.items() if "sha1" in info}
+        known_partials = {p: info["partial"] for p, info in files.items() if "partial" in info}
+        groups, hashes, partials = find_exact_duplicates(cur_files, known, known_partials)
         
-        # 重新分配ID
-        for idx, (file_path, file_info) in enumerate(sorted_files):
-            new_id = f"img_{idx}"
-            new_thumb = os.path.join(TEMP_FOLDER, f"{new_id}.png").replace('\\', '/')
-            
-            old_thumb = file_info.get("thumb", "")
-            if old_thumb and os.path.exists(old_thumb):
-                try:
-                    os.rename(old_thumb, new_thumb)
-                except:
-                    try:
-                        import shutil
-                        shutil.copy2(old_thumb, new_thumb)
-                    except:
-                        pass
-            
-            files[file_path] = {"id": new_id, "thumb": new_thumb}
+        copy_of = {}
+        for group in groups:
+            # 优先沿用已有缩略图的文件作为代表
+            owners = [p for p in group if p in files and not files[p].get("copy_of")]
+            rep = owners[0] if owners else group[0]
+            for p in group:
+                if p != rep:
+                    copy_of[p] = rep
         
-        self.log(f"已重新序列化 {len(files)} 个文件的ID")
+        self._hashes = hashes
+        self._partials = partials
+        self._store_hashes()
+        
+        if copy_of:
+            self.log(f"发现 {len(copy_of)} 个字节完全相同的副本，跳过缩略图处理")
+        return copy_of
+    
+    def _unlink_stale_copies(self, copy_of):
+        """代表文件已变化的副本需要重新处理，返回这些文件"""
+        files = self.db["files"]
+        reps = set(copy_of.values())
+        stale = [p for p, info in files.items()
+                 if info.get("copy_of") and (p in reps or copy_of.get(p) != info["copy_of"])]
+        for p in stale:
+            del files[p]
+            self.db["scan_processed"] -= 1
+        # 仍是副本的文件稍后重新关联，不必处理
+        return [p for p in stale if p not in copy_of]
+    
+    def _link_exact_copies(self, copy_of):
+        """副本记录直接指向代表文件的缩略图"""
+        files = self.db["files"]
+        for p, rep in copy_of.items():
+            rep_info = files.get(rep)
+            if not rep_info or rep_info.get("copy_of"):
+                continue
+            if p not in files:
+                self.db["scan_processed"] += 1
+            files[p] = {"id": rep_info["id"], "thumb": rep_info["thumb"], "copy_of": rep, "stat": self._stats.get(p)}
+        # 新建或重写的记录补上本轮算出的哈希
+        self._store_hashes()
+    
+    def _store_hashes(self):
+        """把全文哈希和首尾块哈希连同 (大小, 修改时间) 存入记录，文件未变时下次扫描直接复用"""
+        files = self.db["files"]
+        for field, values in (("sha1", self._hashes), ("partial", self._partials)):
+            for p, value in values.items():
+                if p in files and files[p].get(field) != list(value):
+                    files[p][field] = list(value)
+                    files.touch(p)
+    
+    def _next_file_id(self):
+        """分配新的文件编号：单调递增的计数器，删除文件后也不复用，其他文件的编号和缩略图不受影响"""
+        if "next_id" not in self.db:
+            # 旧版数据库从现有最大编号之后开始
+            ids = [int(info["id"][4:]) for info in self.db["files"].values()
+                   if str(info.get("id", "")).startswith("img_") and info["id"][4:].isdigit()]
+            self.db["next_id"] = max(ids, default=-1) + 1
+        tid = f"img_{self.db['next_id']}"
+        self.db["next_id"] += 1
+        return tid
     
     def stop_scan(self):
         """停止扫描"""
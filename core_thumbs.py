@@ -0,0 +1,267 @@
+"""缩略图打包存储模块"""
+import os
+import io
+import json
+import mmap
+import time
+import threading
+import cv2
+import numpy as np
+from core_persist import atomic_write_json
+
+# ===================== 配置 =====================
+TEMP_FOLDER = "_image_temp"
+THUMB_FOLDER = os.path.join(TEMP_FOLDER, "thumbs")
+SEGMENT_BYTES = 256 * 1024 * 1024  # 单个数据段上限，写满后新开一段
+COMPACT_RATIO = 0.3  # 废弃数据超过总量的此比例时压缩
+THUMB_FORMATS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp", "raw": None}
+
+def get_thumb_format():
+    """从配置读取缩略图编码 (格式, 质量)"""
+    config_path = os.path.join(TEMP_FOLDER, "config.json")
+    try:
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            fmt = config.get("thumb_format", "png")
+            if fmt in THUMB_FORMATS:
+                return fmt, int(config.get("thumb_quality", 90))
+    except Exception as e:
+        print(f"读取缩略图格式失败，使用 PNG: {str(e)}")
+    return "png", 90
+
+def encode_thumb(img, fmt="png", quality=90):
+    """编码缩略图，返回 (数据, 实际格式)；不支持的像素格式改用 PNG"""
+    if img.dtype == np.uint8:
+        if fmt == "raw":
+            h, w = img.shape[:2]
+            c = 1 if img.ndim == 2 else img.shape[2]
+            return np.ascontiguousarray(img).tobytes(), f"raw:{h}x{w}x{c}"
+        if fmt == "jpeg" and (img.ndim == 2 or img.shape[2] == 3):
+            ok, enc = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok:
+                return enc.tobytes(), fmt
+        if fmt == "webp":
+            ok, enc = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, quality])
+            if ok:
+                return enc.tobytes(), fmt
+    ok, enc = cv2.imencode(".png", img)
+    if not ok:
+        raise ValueError("缩略图编码失败")
+    return enc.tobytes(), "png"
+
+def decode_thumb(data, fmt):
+    """解码缩略图为 cv2 像素数组（BGR / BGRA / 灰度）"""
+    if fmt.startswith("raw:"):
+        h, w, c = (int(v) for v in fmt[4:].split("x"))
+        img = np.frombuffer(data, dtype=np.uint8).reshape((h, w) if c == 1 else (h, w, c))
+        return img.copy()
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+class ThumbStore:
+    """打包缩略图库：只追加的数据段 + 偏移索引，读取走内存映射
+
+    每条索引为 [段号, 偏移, 长度, 格式, 写入时间 ns]。覆盖或删除的条目成为废弃数据，
+    超过一定比例后压缩重写。写入、改名和读取都在同一把锁下进行，可多线程共用。
+    """
+
+    def __init__(self, folder=THUMB_FOLDER):
+        self.folder = folder
+        self.index_path = os.path.join(folder, "index.json")
+        self.fmt, self.quality = get_thumb_format()
+        self.entries = {}
+        self.lock = threading.RLock()
+        self._maps = {}
+        self._writer = None
+        self._load_index()
+
+    def _seg_path(self, seg):
+        return os.path.join(self.folder, f"seg_{seg:05d}.dat")
+
+    def _segments(self):
+        """磁盘上所有数据段的段号"""
+        segs = []
+        for name in os.listdir(self.folder):
+            if name.startswith("seg_") and name.endswith(".dat"):
+                try:
+                    segs.append(int(name[4:-4]))
+                except ValueError:
+                    pass
+        return sorted(segs)
+
+    def _load_index(self):
+        """加载索引，丢弃超出数据段末尾的条目（上次中断时未写完）"""
+        os.makedirs(self.folder, exist_ok=True)
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f).get("entries", {})
+                sizes = {seg: os.path.getsize(self._seg_path(seg)) for seg in self._segments()}
+                self.entries = {k: e for k, e in entries.items() if e[1] + e[2] <= sizes.get(e[0], -1)}
+        except Exception as e:
+            print(f"读取缩略图索引失败，重新建立: {str(e)}")
+            self.entries = {}
+
+    def _append(self, data):
+        """追加到最后一个数据段，写满时新开一段，返回 (段号, 偏移)"""
+        if self._writer is None:
+            segs = self._segments()
+            seg = segs[-1] if segs else 0
+            self._writer = (seg, open(self._seg_path(seg), 'ab', buffering=0))
+        seg, f = self._writer
+        offset = f.seek(0, os.SEEK_END)
+        if offset > 0 and offset + len(data) > SEGMENT_BYTES:
+            f.close()
+            seg += 1
+            f = open(self._seg_path(seg), 'ab', buffering=0)
+            self._writer = (seg, f)
+            offset = 0
+        f.write(data)
+        return seg, offset
+
+    def put_bytes(self, key, data, fmt, written=None):
+        """写入已编码的缩略图"""
+        with self.lock:
+            seg, offset = self._append(data)
+            self.entries[key] = [seg, offset, len(data), fmt, written or time.time_ns()]
+
+    def _map(self, seg, end):
+        """数据段的内存映射，文件变长后重新映射"""
+        mm = self._maps.get(seg)
+        if mm is None or len(mm) < end:
+            if mm is not None:
+                mm.close()
+            with open(self._seg_path(seg), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[seg] = mm
+        return mm
+
+    def read_bytes(self, key):
+        """读取已编码的缩略图，返回 (数据, 格式)，不存在时返回 (None, None)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None, None
+            seg, offset, length, fmt = entry[:4]
+            try:
+                return self._map(seg, offset + length)[offset:offset + length], fmt
+            except (OSError, ValueError):
+                return None, None
+
+    def read_image(self, key):
+        """读取并解码缩略图，失败返回 None"""
+        data, fmt = self.read_bytes(key)
+        if data is None:
+            return None
+        return decode_thumb(data, fmt)
+
+    def open(self, key):
+        """以文件对象形式打开缩略图（供 PIL 读取），不存在返回 None"""
+        data, fmt = self.read_bytes(key)
+        if data is None:
+            return None
+        if fmt.startswith("raw:"):
+            data = cv2.imencode(".png", decode_thumb(data, fmt))[1].tobytes()
+        return io.BytesIO(data)
+
+    def stat(self, key):
+        """缩略图的 (长度, 写入时间 ns)，不存在返回 None"""
+        entry = self.entries.get(key)
+        return None if entry is None else (entry[2], entry[4])
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def retain(self, keys):
+        """只保留指定的键，其余条目成为废弃数据"""
+        keys = set(keys)
+        with self.lock:
+            self.entries = {k: e for k, e in self.entries.items() if k in keys}
+
+    def save(self):
+        """保存索引（先写临时文件再替换）"""
+        with self.lock:
+            atomic_write_json(self.index_path, {"entries": self.entries})
+
+    def close(self):
+        """关闭写入句柄和所有内存映射"""
+        with self.lock:
+            if self._writer is not None:
+                self._writer[1].close()
+                self._writer = None
+            for mm in self._maps.values():
+                mm.close()
+            self._maps = {}
+
+    def compact(self, force=False):
+        """废弃数据超过比例时把有效条目重写到新数据段，再删除旧数据段，返回是否执行"""
+        with self.lock:
+            old_segs = self._segments()
+            total = sum(os.path.getsize(self._seg_path(seg)) for seg in old_segs)
+            live = sum(e[2] for e in self.entries.values())
+            if total == 0 or (not force and total - live <= total * COMPACT_RATIO):
+                return False
+
+            # 按原顺序写入新数据段，新索引保存后才删除旧数据段，中途中断不丢数据
+            self.close()
+            self._writer = (old_segs[-1] + 1, open(self._seg_path(old_segs[-1] + 1), 'ab', buffering=0))
+            entries = {}
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1][:2]):
+                data, fmt = self.read_bytes(key)
+                seg, offset = self._append(data)
+                entries[key] = [seg, offset, len(data), fmt, entry[4]]
+            self.entries = entries
+            self.save()
+            self.close()
+            for seg in old_segs:
+                try:
+                    os.remove(self._seg_path(seg))
+                except OSError:
+                    pass
+            return True
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def thumb_store(folder=THUMB_FOLDER):
+    """进程内共享的缩略图库，扫描、比对和界面使用同一个实例"""
+    with _stores_lock:
+        if folder not in _stores:
+            _stores[folder] = ThumbStore(folder)
+        return _stores[folder]
+
+def close_thumb_store(folder=THUMB_FOLDER):
+    """关闭并丢弃共享实例（删除缓存目录前调用）"""
+    with _stores_lock:
+        store = _stores.pop(folder, None)
+    if store is not None:
+        store.close()
+
+def migrate_legacy_thumbs(files, store=None):
+    """把旧版的单个 PNG 缩略图导入缩略图库，返回导入数量
+
+    沿用 PNG 的文件大小和修改时间作为条目的长度和写入时间，图片指纹不变，特征缓存和比对结果继续有效。
+    """
+    store = store or thumb_store()
+    keys = {}
+    for info in files.values():
+        old = info.get("thumb", "")
+        if not old.lower().endswith(".png"):
+            continue
+        if old not in keys:
+            keys[old] = os.path.splitext(os.path.basename(old))[0]
+            try:
+                with open(old, 'rb') as f:
+                    data = f.read()
+                store.put_bytes(keys[old], data, "png", os.stat(old).st_mtime_ns)
+            except OSError:
+                pass
+        info["thumb"] = keys[old]
+    if keys:
+        store.save()
+        for old in keys:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    return len(keys)
@@ -0,0 +1,133 @@
+"""PyTorch 推理后端"""
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+from core_features import FeatureMatrix
+
+# ===================== 模型 =====================
+class TinyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.feat = nn.Sequential(
+            nn.Conv2d(3, 8, 3, 2, 1), nn.ReLU(),
+            nn.Conv2d(8, 16, 3, 2, 1), nn.ReLU(),
+            nn.Flatten()
+        )
+        self.sim = nn.Sequential(
+            nn.Linear(16 * 32 * 32, 32), nn.ReLU(),
+            nn.Linear(32, 1), nn.Sigmoid()
+        )
+
+    def forward(self, x1, x2):
+        f1 = self.feat(x1)
+        f2 = self.feat(x2)
+        return self.sim(torch.abs(f1 - f2)).squeeze()
+
+def load_model(model_path, device="cpu"):
+    """加载模型到指定设备"""
+    model = TinyModel()
+    model.load_state_dict(torch.load(model_path, map_location="cpu"))
+    if device != "cpu":
+        model = model.to(device)
+    model.eval()
+    return model
+
+def pick_device(use_gpu=False):
+    """选择计算设备：CUDA > MPS > CPU"""
+    if use_gpu:
+        if torch.cuda.is_available():
+            return "cuda"
+        if torch.backends.mps.is_available():
+            return "mps"
+    return "cpu"
+
+def get_threads():
+    """本进程当前的计算线程数"""
+    return torch.get_num_threads()
+
+def set_threads(threads):
+    """设置本进程的计算线程数"""
+    torch.set_num_threads(threads)
+
+def extract_batch(model, x, device="cpu"):
+    """批量提取特征：输入 (N, 3, H, W) float32 数组，返回 (N, dim) float32 数组"""
+    x = torch.from_numpy(x)
+    if device != "cpu":
+        x = x.to(device)
+    with torch.no_grad():
+        return model.feat(x).cpu().numpy()
+
+# ===================== 批量 sim 头 =====================
+class TorchSimHead:
+    """在缓存特征上批量计算 sim 头"""
+
+    def __init__(self, model, device="cpu"):
+        self.layers = model.sim
+        self.sim = model.sim
+        self.device = device
+        self.features = None
+        self.scales = None
+
+    def bind(self, feats):
+        """绑定特征矩阵 (n, dim)，压缩编码的矩阵保持原样，计算时逐块解码"""
+        if isinstance(feats, FeatureMatrix):
+            feats, scales = feats.codes, feats.scales
+        else:
+            scales = None
+        self.features = torch.from_numpy(np.asarray(feats))
+        self.scales = None if scales is None else torch.from_numpy(np.asarray(scales))
+        if self.device != "cpu":
+            self.features = self.features.to(self.device)
+            if self.scales is not None:
+                self.scales = self.scales.to(self.device)
+
+    def rows(self, index):
+        """取出若干行并解码为 float32"""
+        f = self.features[index]
+        if f.dtype != torch.float32:
+            f = f.float()
+        if self.scales is not None:
+            f = f * self.scales[index].unsqueeze(-1)
+        return f
+
+    def weights(self):
+        """sim 头参数 (W1, b1, w2, b2)，numpy 格式"""
+        return (self.layers[0].weight.detach().cpu().numpy(), self.layers[0].bias.detach().cpu().numpy(),
+                self.layers[2].weight.detach().cpu().numpy()[0], float(self.layers[2].bias.item()))
+
+    def tile_scores(self, i0, i1, j0, j1):
+        """计算 F[i0:i1] × F[j0:j1] 整块的相似度矩阵"""
+        fi = self.rows(slice(i0, i1))
+        fj = self.rows(slice(j0, j1))
+        with torch.no_grad():
+            diff = (fi[:, None, :] - fj[None, :, :]).abs_().reshape(-1, fi.shape[1])
+            scores = self.sim(diff).reshape(i1 - i0, j1 - j0)
+        return scores.cpu().numpy()
+
+    def pair_scores(self, ii, jj):
+        """计算指定组合 (ii[k], jj[k]) 的相似度"""
+        ii = torch.from_numpy(ii).to(self.features.device)
+        jj = torch.from_numpy(jj).to(self.features.device)
+        with torch.no_grad():
+            scores = self.sim((self.rows(ii) - self.rows(jj)).abs_()).reshape(-1)
+        return scores.cpu().numpy()
+
+    def tile_gram(self, i0, i1, j0, j1):
+        """计算 F[i0:i1] · F[j0:j1]^T"""
+        with torch.no_grad():
+            gram = self.rows(slice(i0, i1)) @ self.rows(slice(j0, j1)).T
+        return gram.cpu().numpy()
+
+class TracedSimHead(TorchSimHead):
+    """sim 头经 TorchScript 追踪并冻结，省去逐层的 Python 调度，可融合算子"""
+
+    def __init__(self, model, device="cpu"):
+        super().__init__(model, device)
+        example = torch.zeros(1, model.sim[0].in_features, device=device)
+        with torch.no_grad(), warnings.catch_warnings():
+            # 新版 torch 对 TorchScript 给出弃用提示，功能不受影响
+            warnings.simplefilter("ignore", FutureWarning)
+            self.sim = torch.jit.freeze(torch.jit.trace(model.sim.eval(), example))
+
+SimHead = TorchSimHead
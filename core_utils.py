@@ -5,10 +5,12 @@ import shutil
 from PIL import Image, ImageTk
 import tkinter as tk
 from tkinter import ttk, messagebox
+from core_thumbs import THUMB_FOLDER, close_thumb_store
+from core_db import close_workspace_db
 
 # ===================== 配置 =====================
 TEMP_FOLDER = "_image_temp"
-DB_PATH = os.path.join(TEMP_FOLDER, "db.json")
+DB_PATH = os.path.join(TEMP_FOLDER, "db.sqlite")
 RESULT_JS = os.path.join(TEMP_FOLDER, "duplicates.js")
 
 def load_db():
@@ -16,10 +18,10 @@ def load_db():
     from core_scanner import load_db as load_db_scanner
     return load_db_scanner()
 
-def save_db(db):
+def save_db(db, keys=None):
     """保存数据库"""
     from core_scanner import save_db as save_db_scanner
-    save_db_scanner(db)
+    save_db_scanner(db, keys)
 
 def get_device_info():
     """获取设备信息"""
@@ -67,7 +69,7 @@ def get_file_info(file_path):
         return None
 
 def create_thumbnail_image(file_path, max_size=(200, 200)):
-    """创建缩略图图像"""
+    """创建缩略图图像（file_path 可以是路径或缩略图库打开的文件对象）"""
     try:
         img = Image.open(file_path)
         img.thumbnail(max_size, Image.Resampling.LANCZOS)
@@ -89,7 +91,7 @@ def export_results_to_json(db, output_path=None):
     results = {
         "total_files": len(db.get("files", {})),
         "total_duplicates": len(db.get("duplicates", [])),
-        "files": db.get("files", {}),
+        "files": {p: dict(info.items()) for p, info in db.get("files", {}).items()},
         "duplicates": db.get("duplicates", [])
     }
     
@@ -154,7 +156,7 @@ def delete_duplicate_files(db, duplicate_index):
     
     # 更新重复列表
     db["duplicates"].pop(duplicate_index)
-    save_db(db)
+    save_db(db, ("duplicates",))
     
     return True, {
         "deleted": deleted_files,
@@ -169,6 +171,9 @@ def cleanup_temp_files():
             for file in os.listdir(TEMP_FOLDER):
                 if file.endswith('.png') and file.startswith('img_'):
                     os.remove(os.path.join(TEMP_FOLDER, file))
+            close_thumb_store()
+            if os.path.exists(THUMB_FOLDER):
+                shutil.rmtree(THUMB_FOLDER)
         return True, "临时文件清理完成"
     except Exception as e:
         return False, f"清理临时文件失败: {str(e)}"
@@ -176,13 +181,15 @@ def cleanup_temp_files():
 def reset_database():
     """重置数据库"""
     try:
+        close_thumb_store()
+        close_workspace_db()
         if os.path.exists(TEMP_FOLDER):
             shutil.rmtree(TEMP_FOLDER)
         os.makedirs(TEMP_FOLDER, exist_ok=True)
         
         db = {
             "state": "idle", "index": 0, "files": {}, "duplicates": [],
-            "scan_processed": 0, "last_file_list": [], "last_file_count": 0
+            "scan_processed": 0
         }
         save_db(db)
         
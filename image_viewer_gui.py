@@ -13,12 +13,14 @@ from pathlib import Path
 from datetime import datetime
 from PIL import Image, ImageTk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
-from core_scanner import Scanner, load_db, save_db, scan_images
+from core_scanner import Scanner, flush_db, load_db, save_db, scan_images
 from core_comparator import Comparator
+from core_thumbs import thumb_store
+from core_groups import PathGroups
 from core_utils import get_device_info, format_file_size, get_file_info,create_thumbnail_image, create_default_thumbnail,export_results_to_json, export_results_to_csv,delete_duplicate_files, cleanup_temp_files, reset_database,ProgressDialog, show_image_preview as show_preview
 
 # ===================== 调试 =====================
-RUN_MODE = 0  # 0 = 自动，1 = GPU，2 = 多进程
+RUN_MODE = 0  # 0 = 自动，1 = GPU，2 = 多进程（可被配置文件的 run_mode 覆盖）
 RUN_Ver = 1 # 0 = A版，1 = B版
 # ===================== 配置 =====================
 
@@ -29,7 +31,7 @@ def get_resource_path(relative_path):
 
 MODEL_PATH = get_resource_path("tiny_similarity.pth")
 TEMP_FOLDER = "_image_temp"
-DB_PATH = os.path.join(TEMP_FOLDER, "db.json")
+DB_PATH = os.path.join(TEMP_FOLDER, "db.sqlite")
 RESULT_JS = os.path.join(TEMP_FOLDER, "duplicates.js")
 IMG_MAX_SIZE = 400
 IMG_INPUT_SIZE = 128
@@ -104,6 +106,9 @@ def load_config():
 
 config = load_config()
 SIMILARITY_THRESH = config.get("similarity_threshold", 0.9963)
+RUN_MODE = int(config.get("run_mode", RUN_MODE))
+# 自动和多进程模式由比对器按本机调优结果选择后端，GPU 模式固定用 torch
+INFERENCE_BACKEND = "torch" if RUN_MODE == 1 else config.get("inference_backend", "auto")
 
 device_info = get_device_info()
 DEVICE = device_info["device"]
@@ -132,7 +137,13 @@ class ImageDuplicateCheckerGUI:
         
         self.setup_styles()
         
-        self.db = load_db()
+        try:
+            self.db = load_db()
+        except Exception as e:
+            messagebox.showerror("错误", f"无法加载数据库: {str(e)}")
+            raise
+        self.path_groups = None
+
         self.scanning = False
         self.comparing = False
         
@@ -573,7 +584,8 @@ class ImageDuplicateCheckerGUI:
             progress_callback=self.update_compare_progress,
             log_callback=self.log_message,
             use_gpu=use_gpu,
-            threshold=threshold
+            threshold=threshold,
+            backend=INFERENCE_BACKEND
         )
         
         # 在后台线程中运行
@@ -689,11 +701,12 @@ class ImageDuplicateCheckerGUI:
         thumb_frame = ttk.Frame(left_frame)
         thumb_frame.pack(side=tk.LEFT, padx=(0, 15))
 
-        thumb_path = self.db["files"].get(file_path, {}).get("thumb", "")
+        thumb_key = self.db["files"].get(file_path, {}).get("thumb", "")
 
         try:
-            if thumb_path and os.path.exists(thumb_path):
-                img = create_thumbnail_image(thumb_path, max_size=(60, 60))
+            thumb_file = thumb_store().open(thumb_key) if thumb_key else None
+            if thumb_file is not None:
+                img = create_thumbnail_image(thumb_file, max_size=(60, 60))
                 img_label = ttk.Label(thumb_frame, image=img, cursor="hand2")
                 img_label.image = img  
                 img_label.pack()
@@ -809,16 +822,9 @@ class ImageDuplicateCheckerGUI:
                 except Exception as e:
                     errors.append(f"处理文件失败 {current_path}: {str(e)}")
 
-            duplicate_groups[group_number - 1] = [file_path]
-
-            if len(duplicate_groups[group_number - 1]) <= 1:
-                duplicate_groups.pop(group_number - 1)
-            
-            self.db["duplicate_groups"] = duplicate_groups
-
-            self._update_duplicates_from_groups()
+            self._remove_from_groups([p for p in group_files if p != file_path])
 
-            save_db(self.db)
+            save_db(self.db, ("duplicate_groups", "duplicates"))
 
             self.refresh_file_list()
             self.refresh_duplicate_list()
@@ -847,22 +853,9 @@ class ImageDuplicateCheckerGUI:
                     if file_path in self.db["files"]:
                         del self.db["files"][file_path]
 
-                    duplicate_groups = self.db.get("duplicate_groups", [])
-                    updated_groups = []
-                    
-                    for group in duplicate_groups:
-                        if file_path in group:
-                            new_group = [f for f in group if f != file_path]
-                            if len(new_group) > 1:  
-                                updated_groups.append(new_group)
-                        else:
-                            updated_groups.append(group)
-                    
-                    self.db["duplicate_groups"] = updated_groups
+                    self._remove_from_groups([file_path])
 
-                    self._update_duplicates_from_groups()
-
-                    save_db(self.db)
+                    save_db(self.db, ("duplicate_groups", "duplicates"))
 
                     self.refresh_file_list()
                     self.refresh_duplicate_list()
@@ -883,42 +876,15 @@ class ImageDuplicateCheckerGUI:
         if not duplicates:
             return []
 
-        graph = {}
+        path_groups = PathGroups()
         for dup_pair in duplicates:
             if len(dup_pair) >= 2:
-                a, b = dup_pair[0], dup_pair[1]
-                if a not in graph:
-                    graph[a] = set()
-                if b not in graph:
-                    graph[b] = set()
-                graph[a].add(b)
-                graph[b].add(a)
-        
-        visited = set()
-        groups = []
-        
-        for node in graph:
-            if node not in visited:
-                stack = [node]
-                group = []
-                
-                while stack:
-                    current = stack.pop()
-                    if current not in visited:
-                        visited.add(current)
-                        group.append(current)
-                        for neighbor in graph[current]:
-                            if neighbor not in visited:
-                                stack.append(neighbor)
-
-                group.sort()
-                if len(group) > 1:
-                    groups.append(group)
-
+                path_groups.union(dup_pair[0], dup_pair[1])
+        groups = path_groups.groups()
         groups.sort(key=len, reverse=True)
 
         self.db["duplicate_groups"] = groups
-        save_db(self.db)
+        save_db(self.db, ("duplicate_groups",))
         
         return groups
     
@@ -975,11 +941,12 @@ class ImageDuplicateCheckerGUI:
             thumb_frame = ttk.Frame(self.detail_inner_frame, relief=tk.RAISED, borderwidth=2)
             thumb_frame.grid(row=row, column=col, padx=8, pady=8, sticky=tk.NSEW)
 
-            thumb_path = self.db["files"].get(file_path, {}).get("thumb", "")
+            thumb_key = self.db["files"].get(file_path, {}).get("thumb", "")
 
             try:
-                if thumb_path and os.path.exists(thumb_path):
-                    img = create_thumbnail_image(thumb_path, max_size=(120, 120))
+                thumb_file = thumb_store().open(thumb_key) if thumb_key else None
+                if thumb_file is not None:
+                    img = create_thumbnail_image(thumb_file, max_size=(120, 120))
                     img_label = ttk.Label(thumb_frame, image=img, cursor="hand2")
                     img_label.image = img  
                     img_label.pack(padx=8, pady=8)
@@ -1087,12 +1054,9 @@ class ImageDuplicateCheckerGUI:
                     except Exception as e:
                         errors.append(f"删除文件失败 {file_path}: {str(e)}")
 
-                duplicate_groups.pop(group_index)
-                self.db["duplicate_groups"] = duplicate_groups
-
-                self._update_duplicates_from_groups()
+                self._remove_from_groups(group_files[1:])
 
-                save_db(self.db)
+                save_db(self.db, ("duplicate_groups", "duplicates"))
 
                 self.refresh_file_list()
                 self.refresh_duplicate_list()
@@ -1106,17 +1070,36 @@ class ImageDuplicateCheckerGUI:
                 
                 messagebox.showinfo("成功", f"已删除分组，删除了 {len(deleted_files)} 张图片")
     
+    def _path_groups(self):
+        """当前相似组的并查集，分组列表被整体替换（如重新比对）后重建"""
+        groups = self.db.get("duplicate_groups", [])
+        if self.path_groups is None or self.path_groups[0] is not groups:
+            self.path_groups = (groups, PathGroups(groups))
+        return self.path_groups[1]
+    
+    def _remove_from_groups(self, paths):
+        """把图片移出所在分组（不足两张的分组随之消失），并同步重复对列表"""
+        path_groups = self._path_groups()
+        for path in paths:
+            path_groups.discard(path)
+        self.db["duplicate_groups"] = path_groups.groups()
+        self.path_groups = (self.db["duplicate_groups"], path_groups)
+        self._update_duplicates_from_groups()
+    
     def _update_duplicates_from_groups(self): 
-        """从分组数据更新对列表"""
+        """从分组数据更新对列表：只保留两端仍在同一分组中的已比对重复对"""
         duplicate_groups = self.db.get("duplicate_groups", [])
-        duplicates = []
+        group_of = {}
         
-        for group in duplicate_groups:
+        for idx, group in enumerate(duplicate_groups):
             if len(group) >= 2:
-                # 为每组生成图片对
-                for i in range(len(group)):
-                    for j in range(i + 1, len(group)):
-                        duplicates.append([group[i], group[j]])
+                for path in group:
+                    group_of[path] = idx
+        
+        duplicates = []
+        for dup_pair in self.db.get("duplicates", []):
+            if len(dup_pair) >= 2 and dup_pair[0] in group_of and group_of[dup_pair[0]] == group_of.get(dup_pair[1]):
+                duplicates.append(dup_pair)
         
         self.db["duplicates"] = duplicates
     
@@ -1205,7 +1188,7 @@ class ImageDuplicateCheckerGUI:
 
                 if file_path in self.db["files"]:
                     del self.db["files"][file_path]
-                    save_db(self.db)
+                    save_db(self.db, ())
 
                 self.refresh_file_list()
                 self.refresh_duplicate_list()
@@ -1273,9 +1256,10 @@ class ImageDuplicateCheckerGUI:
         """显示图片预览窗口"""
         try:
             if not os.path.exists(image_path):
-                thumb_path = self.db["files"].get(image_path, {}).get("thumb", "")
-                if thumb_path and os.path.exists(thumb_path):
-                    show_preview(self.root, thumb_path, f"{title} (缩略图)")
+                thumb_key = self.db["files"].get(image_path, {}).get("thumb", "")
+                thumb_file = thumb_store().open(thumb_key) if thumb_key else None
+                if thumb_file is not None:
+                    show_preview(self.root, thumb_file, f"{title} (缩略图)")
                     return
                 else:
                     messagebox.showwarning("警告", "图片文件不存在")
@@ -1366,16 +1350,9 @@ class ImageDuplicateCheckerGUI:
 
                     time.sleep(0.1)  
 
-                new_groups = []
-                for group in duplicate_groups:
-                    if len(group) >= 2:
-                        new_groups.append([group[0]])  
-                
-                self.db["duplicate_groups"] = new_groups
+                self._remove_from_groups([p for group in duplicate_groups for p in group[1:]])
 
-                self._update_duplicates_from_groups()
-
-                save_db(self.db)
+                save_db(self.db, ("duplicate_groups", "duplicates"))
 
                 progress_dialog.close()
 
@@ -1911,14 +1888,15 @@ class ImageDuplicateCheckerGUI:
         self.log_message(f"设置已保存: 阈值={new_threshold:.4f}")
         messagebox.showinfo("成功", "设置已保存，重启后生效")
         
-        # 保存到配置文件
+        # 保存到配置文件（保留调优结果等其他配置项）
         config_path = os.path.join(TEMP_FOLDER, "config.json")
-        config = {
+        config = load_config()
+        config.update({
             "similarity_threshold": new_threshold,
             "break_on_error": self.break_on_error_var.get(),
             "print_error_log": self.print_error_log_var.get(),
             "show_delete_confirm": self.show_delete_confirm_var.get()
-        }
+        })
         
         try:
             with open(config_path, 'w', encoding='utf-8') as f:
@@ -2205,6 +2183,8 @@ def main():
     root = tk.Tk()
     app = ImageDuplicateCheckerGUI(root) 
     root.mainloop()
+    # 等待后台保存写完再退出
+    flush_db()
 
 if __name__ == "__main__":
     import multiprocessing
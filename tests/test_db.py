@@ -0,0 +1,88 @@
+"""工作区数据库测试"""
+import json
+import os
+import pytest
+from core_db import WorkspaceDB, close_workspace_db, migrate_legacy_db, workspace_db
+
+def test_full_save_drops_fields_of_queued_partial_save(tmp_path):
+    """部分保存排队后再全量保存：已从 db 中删除的字段不能被旧值写回"""
+    workspace = WorkspaceDB(str(tmp_path / "db.sqlite"))
+    db = {"files": {}, "state": "comparing", "compare_index": 5, "compare_plan": {"rows": 3}}
+    workspace.save(db)
+
+    partial = workspace.collect(db, ["compare_index"])
+    db.pop("compare_index")
+    db.pop("compare_plan")
+    db["state"] = "idle"
+    full = workspace.collect(db)
+    workspace.write(WorkspaceDB.merge(partial, full))
+
+    loaded = workspace.load()
+    assert loaded["state"] == "idle"
+    assert "compare_index" not in loaded
+    assert "compare_plan" not in loaded
+    workspace.close()
+
+def test_partial_save_after_full_save_keeps_both(tmp_path):
+    """全量保存后再部分保存：两批改动都写入"""
+    workspace = WorkspaceDB(str(tmp_path / "db.sqlite"))
+    db = {"files": {"a.png": {"id": "1"}}, "state": "scanning"}
+    full = workspace.collect(db)
+    db["index"] = 7
+    partial = workspace.collect(db, ["index"])
+    workspace.write(WorkspaceDB.merge(full, partial))
+
+    loaded = workspace.load()
+    assert loaded["state"] == "scanning"
+    assert loaded["index"] == 7
+    assert loaded["files"]["a.png"] == {"id": "1"}
+    workspace.close()
+
+def test_migrate_baseline_db_json(tmp_path):
+    """旧版 db.json（重复对只有 [a, b]）完整导入，原文件改名为 .bak"""
+    legacy = {
+        "state": "idle", "index": 0, "scan_processed": 2, "compare_index": 1, "last_compare_count": 2,
+        "files": {"a.png": {"id": "1", "thumb": "1"}, "b.png": {"id": "2", "thumb": "2"}},
+        "duplicates": [["a.png", "b.png"]], "duplicate_groups": [["a.png", "b.png"]],
+        "last_file_list": ["a.png", "b.png"], "last_file_count": 2,
+    }
+    legacy_path = tmp_path / "db.json"
+    legacy_path.write_text(json.dumps(legacy, ensure_ascii=False, indent=2), encoding="utf-8")
+    workspace = WorkspaceDB(str(tmp_path / "db.sqlite"))
+    assert migrate_legacy_db(workspace, str(legacy_path))
+
+    loaded = workspace.load()
+    assert loaded["duplicates"] == [["a.png", "b.png", None]]
+    assert loaded["duplicate_groups"] == [["a.png", "b.png"]]
+    assert loaded["files"].to_dict() == legacy["files"]
+    assert loaded["scan_processed"] == 2
+    assert "last_file_list" not in loaded
+    assert not legacy_path.exists() and os.path.exists(str(legacy_path) + ".bak")
+    workspace.close()
+
+def test_failed_migration_keeps_db_json(tmp_path):
+    """导入失败时抛出异常，db.json 保持原样"""
+    legacy_path = tmp_path / "db.json"
+    legacy_path.write_text('{"files": {', encoding="utf-8")
+    path = str(tmp_path / "db.sqlite")
+    with pytest.raises(RuntimeError):
+        workspace_db(path)
+    assert legacy_path.read_text(encoding="utf-8") == '{"files": {'
+    close_workspace_db(path)
+
+def test_collect_snapshots_mutable_values(tmp_path):
+    """collect 之后原地修改列表、字典和记录，写入的仍是 collect 时的内容"""
+    workspace = WorkspaceDB(str(tmp_path / "db.sqlite"))
+    db = {"files": {"a.png": {"id": "1"}}, "duplicates": [["a.png", "b.png", 0.9], ["a.png", "c.png", 0.8]],
+          "compare_plan": {"order": ["a.png"]}}
+    changes = workspace.collect(db)
+    db["duplicates"].pop(0)
+    db["compare_plan"]["order"] = []
+    db["files"]["a.png"]["id"] = "2"
+    workspace.write(changes)
+
+    loaded = workspace.load()
+    assert loaded["duplicates"] == [["a.png", "b.png", 0.9], ["a.png", "c.png", 0.8]]
+    assert loaded["compare_plan"] == {"order": ["a.png"]}
+    assert loaded["files"]["a.png"] == {"id": "1"}
+    workspace.close()
@@ -0,0 +1,59 @@
+"""批量比对引擎测试"""
+import pickle
+import numpy as np
+import pytest
+from core_engine import PruningBounds, iter_tiled_pairs
+from core_numpy import NumpySimHead
+
+class _Model:
+    """随机权重的 sim 头：sigmoid(w2 · relu(W1 · |fi - fj| + b1) + b2)"""
+
+    def __init__(self, rng, dim, hidden):
+        # 权重取小值，避免 sigmoid 在 float32 下饱和为 1
+        self.W1 = rng.normal(scale=0.3, size=(hidden, dim)).astype(np.float32)
+
+        self.b1 = rng.normal(size=hidden).astype(np.float32)
+        self.w2 = rng.normal(size=hidden).astype(np.float32)
+        self.b2 = float(rng.normal())
+
+    def sim(self, diff):
+        hidden = np.maximum(diff @ self.W1.T + self.b1, 0)
+        return 1 / (1 + np.exp(-(hidden @ self.w2 + self.b2)))
+
+def _random_case(seed, n=60, dim=32, hidden=8):
+    rng = np.random.default_rng(seed)
+    # 非负特征（ReLU 输出），成簇分布以便产生超过阈值的组合
+    centers = np.maximum(rng.normal(size=(6, dim)), 0)
+    feats = np.maximum(centers[rng.integers(0, 6, n)] + rng.normal(scale=0.1, size=(n, dim)), 0)
+    feats = feats.astype(np.float32)
+    head = NumpySimHead(_Model(rng, dim, hidden))
+    head.bind(feats)
+    scores = head.tile_scores(0, n, 0, n)[np.triu_indices(n, 1)]
+    threshold = min(float(np.quantile(scores, rng.uniform(0.5, 0.99))), 0.999)
+
+    return feats, head, threshold
+
+def _pairs(head, n, threshold, block, bounds=None):
+    return {(i, j) for *_, found in iter_tiled_pairs(head, n, threshold, block, bounds=bounds) for i, j, _ in found}
+
+@pytest.mark.parametrize("seed", range(20))
+def test_pruning_keeps_every_pair(seed):
+    """剪枝前后找到的组合完全相同"""
+    feats, head, threshold = _random_case(seed)
+    bounds = PruningBounds(head.weights(), threshold, groups=4)
+    bounds.bind(feats)
+    block = 7 + seed % 5
+    assert _pairs(head, len(feats), threshold, block, bounds) == _pairs(head, len(feats), threshold, block)
+
+def test_shared_bounds_pickle_by_path(tmp_path):
+    """绑定到共享矩阵的统计量不随对象序列化，反序列化后重新挂载，结果不变"""
+    feats, head, threshold = _random_case(0)
+    path = str(tmp_path / "run_test.npy")
+    np.save(path, feats)
+    bounds = PruningBounds(head.weights(), threshold, groups=4)
+    bounds.bind(feats, path=path)
+    data = pickle.dumps(bounds)
+    assert len(data) < bounds.P.nbytes
+    copy = pickle.loads(data)
+    np.testing.assert_array_equal(copy.P, bounds.P)
+    assert _pairs(head, len(feats), threshold, 8, copy) == _pairs(head, len(feats), threshold, 8)
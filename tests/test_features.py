@@ -0,0 +1,53 @@
+"""特征库与模型输入缓存测试"""
+import os
+import numpy as np
+from core_features import FeatureStore, InputStore
+
+def test_feature_store_compact_keeps_live_rows(tmp_path):
+    """特征库压缩：只保留有效指纹，读出的特征与压缩前一致"""
+    store = FeatureStore("m", folder=str(tmp_path), dim=8, encoding="int8")
+    feats = np.random.default_rng(0).random((10, 8), dtype=np.float32)
+    fps = [f"fp{i}" for i in range(10)]
+    store.append(fps, feats)
+    store.save()
+    before = store.matrix(store.lookup(fps))[:]
+
+    live = fps[5:8] + fps[:1]
+    store.retain(live)
+    assert store.compact()
+    assert os.path.getsize(store.data_path) == 4 * 8
+    assert os.path.getsize(store.scale_path) == 4 * 4
+
+    reopened = FeatureStore("m", folder=str(tmp_path), dim=8, encoding="int8")
+    assert sorted(reopened.index) == sorted(live)
+    rows = reopened.lookup(live)
+    np.testing.assert_array_equal(reopened.matrix(rows)[:], before[[5, 6, 7, 0]])
+    assert reopened.lookup(["fp3"])[0] == -1
+
+def test_feature_store_compact_below_ratio_is_skipped(tmp_path):
+    """废弃行比例未超过阈值时不重写数据文件"""
+    store = FeatureStore("m", folder=str(tmp_path), dim=4)
+    store.append([f"fp{i}" for i in range(10)], np.ones((10, 4), dtype=np.float32))
+    store.retain([f"fp{i}" for i in range(8)])
+    assert not store.compact()
+    assert os.path.getsize(store.data_path) == 10 * 4 * 4
+    assert store.compact(force=True)
+    assert os.path.getsize(store.data_path) == 8 * 4 * 4
+
+def test_input_store_compact_then_append(tmp_path):
+    """模型输入缓存压缩后继续追加，行号接在有效行之后"""
+    store = InputStore(folder=str(tmp_path), size=2)
+    imgs = [np.full((2, 2, 3), i, dtype=np.uint8) for i in range(6)]
+    for i, img in enumerate(imgs):
+        store.append(f"fp{i}", img)
+    store.save()
+
+    store.retain(["fp4", "fp1"])
+    assert store.compact()
+    store.append("fp9", imgs[3])
+    store.save()
+
+    reopened = InputStore(folder=str(tmp_path), size=2)
+    rows = reopened.lookup(["fp1", "fp4", "fp9", "fp0"])
+    assert list(rows) == [0, 1, 2, -1]
+    np.testing.assert_array_equal(reopened.read(rows[:3]), np.stack([imgs[1], imgs[4], imgs[3]]))
@@ -0,0 +1,55 @@
+"""相似分组测试"""
+import random
+import pytest
+from core_groups import DisjointSet, PathGroups
+
+def _components(n, edges):
+    """DFS 求连通分量（至少两个节点）"""
+    adj = {i: [] for i in range(n)}
+    for a, b in edges:
+        adj[a].append(b)
+        adj[b].append(a)
+    seen = set()
+    out = []
+    for start in range(n):
+        if start in seen or not adj[start]:
+            continue
+        seen.add(start)
+        stack = [start]
+        comp = []
+        while stack:
+            x = stack.pop()
+            comp.append(x)
+            for y in adj[x]:
+                if y not in seen:
+                    seen.add(y)
+                    stack.append(y)
+        out.append(comp)
+    return out
+
+def _normalize(groups):
+    return sorted(sorted(g) for g in groups)
+
+@pytest.mark.parametrize("seed", range(50))
+def test_disjoint_set_matches_dfs(seed):
+    """随机边集上并查集分组与 DFS 连通分量一致，边逐条并入的任意时刻都成立"""
+    rng = random.Random(seed)
+    n = rng.randint(2, 60)
+    edges = [(rng.randrange(n), rng.randrange(n)) for _ in range(rng.randint(0, 2 * n))]
+    edges = [(a, b) for a, b in edges if a != b]
+    sets = DisjointSet()
+    for k, (a, b) in enumerate(edges):
+        sets.union(a, b)
+        if k % 10 == 0:
+            assert _normalize(sets.groups()) == _normalize(_components(n, edges[:k + 1]))
+    assert _normalize(sets.groups()) == _normalize(_components(n, edges))
+    for a, b in edges:
+        assert sets.find(a) == sets.find(b)
+        assert sorted(sets.group_of(a)) == sorted(sets.group_of(b))
+
+def test_path_groups_discard():
+    """移出的路径不再出现在分组中，其余成员仍在同一组"""
+    groups = PathGroups([["a", "b"], ["b", "c"], ["d", "e"]])
+    assert groups.groups() == [["a", "b", "c"], ["d", "e"]]
+    groups.discard("b")
+    assert groups.groups() == [["a", "c"], ["d", "e"]]
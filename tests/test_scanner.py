@@ -0,0 +1,41 @@
+"""扫描模块测试"""
+import os
+import core_scanner
+from core_scanner import HASH_CHUNK, file_stat, find_exact_duplicates
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+def test_exact_duplicates_reuse_cached_hashes(tmp_path, monkeypatch):
+    """文件未变时首尾块哈希和全文哈希都直接复用，不再读取文件"""
+    body = os.urandom(3 * HASH_CHUNK)
+    a = _write(tmp_path / "a.bin", body)
+    b = _write(tmp_path / "b.bin", body)
+    c = _write(tmp_path / "c.bin", body[:-1] + bytes([body[-1] ^ 1]))
+    stats = {p: file_stat(p) for p in (a, b, c)}
+    groups, hashes, partials = find_exact_duplicates(stats)
+    assert groups == [sorted([a, b])]
+    assert set(partials) == {a, b, c}
+
+    def fail(*args):
+        raise AssertionError("不应重新读取文件")
+    monkeypatch.setattr(core_scanner, "partial_hash", fail)
+    monkeypatch.setattr(core_scanner, "full_hash", fail)
+    again = find_exact_duplicates(stats, hashes, partials)
+    assert again == (groups, hashes, partials)
+
+def test_exact_duplicates_rehash_changed_file(tmp_path):
+    """修改时间变化后重新计算首尾块哈希"""
+    body = os.urandom(3 * HASH_CHUNK)
+    a = _write(tmp_path / "a.bin", body)
+    b = _write(tmp_path / "b.bin", body)
+    stats = {p: file_stat(p) for p in (a, b)}
+    _, hashes, partials = find_exact_duplicates(stats)
+    _write(b, bytes([body[0] ^ 1]) + body[1:])
+    os.utime(b, ns=(stats[b][1] + 10 ** 9, stats[b][1] + 10 ** 9))
+    stats[b] = file_stat(b)
+    groups, _, partials = find_exact_duplicates(stats, hashes, partials)
+    assert groups == []
+    assert partials[b][1] == stats[b][1]